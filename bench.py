@@ -0,0 +1,272 @@
+#!/usr/bin/env python3
+# bench.py - offline micro-benchmarks for bot.py (no Telegram connection needed)
+#
+# Drives the real handlers (handle_photo, handle_video, callback_query_router)
+# through Application.process_update with synthetic updates and a fake Bot API
+# transport, and times the storage helpers (load_data, save_data + flush,
+# ensure_user_record) against a temporary database.
+#
+# Usage:
+#   python bench.py                                  # 1k users, all scenarios
+#   python bench.py --users 1000000 --only storage
+#   python bench.py --ops 5000 --concurrency 64 --api-latency 50
+#   python bench.py --only video --rate-limits        # with the real outbound limits
+
+import argparse
+import asyncio
+import io
+import itertools
+import json
+import os
+import resource
+import sys
+import tempfile
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SCENARIOS = ("storage", "photo", "video", "callback")
+
+
+# ---------------- Fake Bot API ----------------
+def _fake_jpeg() -> bytes:
+    try:
+        from PIL import Image
+    except ImportError:
+        return b""
+    buf = io.BytesIO()
+    Image.new("RGB", (1280, 720), (40, 90, 160)).save(buf, "JPEG")
+    return buf.getvalue()
+
+
+def make_fake_request(latency: float):
+    from telegram.request import BaseRequest
+
+    photo_bytes = _fake_jpeg()
+
+    class FakeRequest(BaseRequest):
+        """Answers every Bot API method locally, after `latency` seconds."""
+
+        def __init__(self):
+            self.calls: Dict[str, int] = {}
+            self._message_id = 0
+
+        async def initialize(self) -> None:
+            pass
+
+        async def shutdown(self) -> None:
+            pass
+
+        @property
+        def read_timeout(self) -> Optional[float]:
+            return None
+
+        def _message(self, chat_id: Any) -> Dict[str, Any]:
+            self._message_id += 1
+            return {"message_id": self._message_id, "date": 0, "chat": {"id": int(chat_id), "type": "private"}}
+
+        def _result(self, method: str, params: Dict[str, Any]) -> Any:
+            if method == "getMe":
+                return {"id": 1, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+            if method == "getChatMember":
+                return {"status": "member", "user": {"id": int(params["user_id"]), "is_bot": False, "first_name": "u"}}
+            if method == "getFile":
+                return {"file_id": params["file_id"], "file_unique_id": params["file_id"], "file_path": f"photos/{params['file_id']}.jpg"}
+            if method == "sendMediaGroup":
+                return [self._message(params.get("chat_id", 1)) for _ in params["media"]]
+            if method == "sendPhoto":
+                message = self._message(params.get("chat_id", 1))
+                message["photo"] = [{"file_id": f"sent{self._message_id}", "file_unique_id": f"sent{self._message_id}",
+                                     "width": 320, "height": 320}]
+                return message
+            if method.startswith(("send", "copy", "edit")):
+                return self._message(params.get("chat_id", 1))
+            return True
+
+        async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None,
+                             connect_timeout=None, pool_timeout=None) -> Tuple[int, bytes]:
+            if latency:
+                await asyncio.sleep(latency)
+            if "/file/bot" in url:
+                return 200, photo_bytes
+            api_method = url.rsplit("/", 1)[-1]
+            self.calls[api_method] = self.calls.get(api_method, 0) + 1
+            params = request_data.parameters if request_data else {}
+            return 200, json.dumps({"ok": True, "result": self._result(api_method, params)}).encode()
+
+    return FakeRequest()
+
+
+# ---------------- Synthetic updates ----------------
+def _user(uid: int) -> Dict[str, Any]:
+    return {"id": uid, "is_bot": False, "first_name": f"user{uid}"}
+
+
+def _message(update_id: int, uid: int, **content) -> Dict[str, Any]:
+    msg = {"message_id": update_id, "date": int(time.time()), "chat": {"id": uid, "type": "private"}, "from": _user(uid)}
+    msg.update(content)
+    return {"update_id": update_id, "message": msg}
+
+
+def photo_update(update_id: int, uid: int) -> Dict[str, Any]:
+    sizes = [
+        {"file_id": f"p{uid}_{side}", "file_unique_id": f"pu{uid}_{side}", "width": side, "height": side, "file_size": side * 100}
+        for side in (90, 320, 1280)
+    ]
+    return _message(update_id, uid, photo=sizes)
+
+
+def video_update(update_id: int, uid: int) -> Dict[str, Any]:
+    video = {"file_id": f"v{update_id}", "file_unique_id": f"vu{update_id}", "width": 1280, "height": 720, "duration": 60}
+    return _message(update_id, uid, video=video, caption="bench <b>video</b>")
+
+
+def callback_update(update_id: int, uid: int, data: str = "force_check") -> Dict[str, Any]:
+    prompt = {"message_id": 1, "date": 0, "chat": {"id": uid, "type": "private"}, "photo": [
+        {"file_id": "logo", "file_unique_id": "logo", "width": 320, "height": 320},
+    ]}
+    return {"update_id": update_id, "callback_query": {
+        "id": str(update_id), "from": _user(uid), "chat_instance": "bench", "data": data, "message": prompt,
+    }}
+
+
+# ---------------- Measurement ----------------
+def peak_rss_mb() -> float:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def report(name: str, latencies: List[float], elapsed: float) -> None:
+    latencies = sorted(latencies)
+    n = len(latencies)
+    p50 = latencies[n // 2] * 1000 if n else 0.0
+    p99 = latencies[min(n - 1, int(n * 0.99))] * 1000 if n else 0.0
+    ops = n / elapsed if elapsed else 0.0
+    print(f"{name:<28} {n:>9} {ops:>12.1f} {p50:>10.3f} {p99:>10.3f} {peak_rss_mb():>10.1f}")
+
+
+def timed(fn, *args) -> float:
+    start = time.perf_counter()
+    fn(*args)
+    return time.perf_counter() - start
+
+
+# ---------------- Scenarios ----------------
+def populate(bot, users: int) -> None:
+    """Write `users` synthetic records straight into the store."""
+    conn = bot.get_conn()
+    record = json.dumps({"thumbnail_file_id": None, "state": "idle", "pending_videos": []})
+    with bot.transaction():
+        conn.execute("DELETE FROM users")
+        conn.executemany("INSERT INTO users (id, record) VALUES (?, ?)", ((uid, record) for uid in range(1, users + 1)))
+
+
+def bench_storage(bot, users: int, ops: int) -> None:
+    # keep the write-behind thread idle so the flush below is measured in full
+    bot.PERSISTENCE.interval = 3600
+    bot.PERSISTENCE.max_dirty = float("inf")
+    populate(bot, users)
+    start = time.perf_counter()
+    bot.load_data(lazy=True)
+    report(f"load_data lazy ({users} users)", [time.perf_counter() - start], time.perf_counter() - start)
+    start = time.perf_counter()
+    bot.DB = bot.load_data()
+    report(f"load_data ({users} users)", [time.perf_counter() - start], time.perf_counter() - start)
+    bot.PERSISTENCE.data = bot.DB
+
+    ids = [1 + (i * 7919) % users for i in range(ops)]
+    lat = [timed(bot.ensure_user_record, uid) for uid in ids]
+    report("ensure_user_record (hit)", lat, sum(lat))
+
+    new_ids = range(users + 1, users + 1 + ops)
+    lat = [timed(bot.ensure_user_record, uid) for uid in new_ids]
+    report("ensure_user_record (new)", lat, sum(lat))
+
+    lat = [timed(bot.save_data, bot.DB, uid) for uid in ids]
+    report("save_data (mark dirty)", lat, sum(lat))
+
+    flush = timed(bot.PERSISTENCE.flush)
+    report(f"write-behind flush ({len(set(ids)) + ops} rows)", [flush], flush)
+
+
+_update_ids = itertools.count(10_000_000, 10_000_000)
+
+
+async def bench_updates(bot, application, name: str, make_update, uids: List[int], concurrency: int) -> None:
+    from telegram import Update
+
+    # fresh update ids per scenario: bot.py skips update ids it has already handled
+    first = next(_update_ids)
+    updates = [Update.de_json(make_update(first + i, uid), application.bot) for i, uid in enumerate(uids)]
+    gate = asyncio.Semaphore(concurrency)
+    latencies: List[float] = []
+
+    async def run(update) -> None:
+        async with gate:
+            start = time.perf_counter()
+            await application.update_processor.process_update(update, application.process_update(update))
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(run(u) for u in updates))
+    report(name, latencies, time.perf_counter() - start)
+
+
+async def bench_handlers(bot, args) -> None:
+    request = make_fake_request(args.api_latency / 1000)
+    bot.MAX_CONCURRENT_UPDATES = args.concurrency
+    if not args.rate_limits:
+        # measure handler cost, not Telegram's budgets
+        bot.RATE_LIMIT_GLOBAL = bot.RATE_LIMIT_CHAT = bot.RATE_LIMIT_CHAT_BURST = 1e9
+    application = bot.build_application(token="123456:BENCH", request=request)
+    uids = [1 + i % args.users for i in range(args.ops)]
+    async with application:
+        if "photo" in args.only:
+            # users sent /addthumb first: the photo becomes their thumbnail
+            for uid in set(uids):
+                bot.ensure_user_record(uid).state = "waiting_for_thumb"
+            await bench_updates(bot, application, "handle_photo", photo_update, uids, args.concurrency)
+        if "video" in args.only:
+            for uid in set(uids):
+                rec = bot.ensure_user_record(uid)
+                if not rec.thumbnail_file_id:
+                    rec.thumbnail_file_id = f"p{uid}_1280"
+            await bench_updates(bot, application, "handle_video", video_update, uids, args.concurrency)
+        if "callback" in args.only:
+            for uid in set(uids):
+                bot.ensure_user_record(uid).add_pending({"file_id": f"v{uid}", "file_unique_id": f"vu{uid}", "caption": ""})
+            await bench_updates(bot, application, "callback force_check", callback_update, uids, args.concurrency)
+    print(f"Bot API calls: {json.dumps(request.calls, sort_keys=True)}")
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Offline benchmarks for bot.py")
+    parser.add_argument("--users", type=int, default=1000, help="user records in the store (1k .. 1M)")
+    parser.add_argument("--ops", type=int, default=2000, help="operations per scenario")
+    parser.add_argument("--concurrency", type=int, default=32, help="updates processed in parallel")
+    parser.add_argument("--api-latency", type=float, default=0.0, help="simulated Bot API latency in ms")
+    parser.add_argument("--rate-limits", action="store_true", help="keep the outbound rate limiter at Telegram's limits")
+    parser.add_argument("--only", nargs="+", choices=SCENARIOS, default=list(SCENARIOS))
+    args = parser.parse_args(argv)
+
+    # bot.py opens its database, log file and thumbnail directory relative to the cwd
+    workdir = tempfile.mkdtemp(prefix="coverbot-bench-")
+    os.chdir(workdir)
+    sys.path.insert(0, HERE)
+    import bot
+
+    bot.setup_logging()
+    print(f"workdir: {workdir}")
+    print(f"{'scenario':<28} {'ops':>9} {'ops/sec':>12} {'p50 ms':>10} {'p99 ms':>10} {'rss MB':>10}")
+    if "storage" in args.only:
+        bench_storage(bot, args.users, args.ops)
+    else:
+        populate(bot, args.users)
+        bot.DB = bot.load_data()
+        bot.PERSISTENCE.data = bot.DB
+    if set(args.only) - {"storage"}:
+        asyncio.run(bench_handlers(bot, args))
+    bot.PERSISTENCE.stop()
+
+
+if __name__ == "__main__":
+    main()
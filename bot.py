@@ -1,31 +1,69 @@
 #!/usr/bin/env python3
 # bot.py - Professional Video Cover / Thumbnail Bot (single file)
-# Requirements: python-telegram-bot >= 20.0
-# pip install python-telegram-bot --upgrade
+# Requirements: python-telegram-bot[job-queue] >= 20.4 (aiohttp for webhook mode, Pillow for thumbnail
+#               processing, ffmpeg for auto covers)
+# pip install "python-telegram-bot[job-queue]" --upgrade
 
 import os
+import sys
+import copy
+import csv
 import json
 import logging
+import logging.handlers
+import queue
+import random
 import html
 import asyncio
-from typing import Dict, Any, Optional, List
+import sqlite3
+import threading
+import atexit
+import signal
+import io
+import subprocess
+import multiprocessing
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+import time
+import functools
+import heapq
+import itertools
+from collections import OrderedDict, defaultdict
+import contextlib
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Any, Optional, List, Set, Iterable, Tuple, Union, Callable
+
+import httpx
+
+try:
+    from PIL import Image  # optional: without Pillow the raw photo file_id is used as thumb
+except ImportError:
+    Image = None
 
 from telegram import (
     Update,
     InlineKeyboardButton,
     InlineKeyboardMarkup,
     InputMediaPhoto,
+    InputMediaVideo,
+    Message,
     MessageEntity,
     constants,
 )
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TimedOut
 from telegram.ext import (
     Application,
+    BaseRateLimiter,
+    BaseUpdateProcessor,
     CommandHandler,
     MessageHandler,
     CallbackQueryHandler,
+    ChatMemberHandler,
     ContextTypes,
     filters,
 )
+from telegram.request import BaseRequest, HTTPXRequest
 
 # ---------------- CONFIG ----------------
 BOT_TOKEN = ""  # <<-- set your bot token
@@ -33,69 +71,906 @@ OWNER_ID: int = 6040503076  # provided by you
 FORCE_SUB_CHANNEL_ID = -1002432405855  # channel user must join
 FORCE_SUB_CHANNEL_LINK = "https://t.me/World_Fastest_Bots"
 LOG_CHANNEL_ID = -1003180409625  # separate real log channel (provided)
-DATA_FILE = "user_data.json"
+DB_FILE = "user_data.db"  # SQLite (WAL) user store
+DATA_FILE = "user_data.json"  # legacy JSON store, migrated into DB_FILE on first start
 BOT_LOGO = "https://i.ibb.co/d4DX7vRW/x.jpg"
+FLUSH_INTERVAL = 2.0  # seconds between write-behind flushes of changed users
+FLUSH_MAX_DIRTY = 500  # flush early once this many users are waiting to be written
+LAZY_LOAD = True  # serve updates right away: records are read on first access and loaded in the background
+WARMUP_BATCH = 5000  # records per background load step
+IMPORT_BATCH = 1000  # rows per transaction in `python bot.py import`
+SWEEP_INTERVAL = 3600  # seconds between runs of the stale state sweeper
+STATE_TTL = 24 * 3600  # a non-idle state (waiting for a thumbnail, force-sub check ...) expires after this idle time
+PENDING_TTL = 3 * 24 * 3600  # queued videos are dropped after this idle time
+SWEEP_VACUUM_MIN_BYTES = 16 * 1024 * 1024  # VACUUM once this much of DB_FILE is free pages
+MEMBER_CACHE_TTL = 600  # seconds a confirmed channel member is trusted without get_chat_member
+NON_MEMBER_CACHE_TTL = 30  # seconds a "not a member" answer is trusted
+MEMBER_CACHE_SIZE = 100_000  # max cached membership answers (LRU)
+BROADCAST_RATE = 25  # broadcast messages per second (Telegram allows ~30/s overall)
+BROADCAST_WORKERS = 20  # concurrent broadcast sends
+BROADCAST_CHUNK = 500  # users per progress checkpoint
+BROADCAST_MAX_RETRIES = 5  # attempts per user on RetryAfter / network errors
+BROADCAST_PROGRESS_INTERVAL = 15  # seconds between status message edits
+ACTIVITY_DAYS = 90  # days of per-day activity kept for "active<N>d" broadcast segments
+IDEMPOTENCY_CACHE_SIZE = 100_000  # handled update ids and sent videos remembered (memory and DB_FILE)
+IDEMPOTENCY_TTL = 7 * 24 * 3600  # the sweeper drops remembered entries older than this
+LOG_DIGEST_INTERVAL = 10  # seconds of log events folded into one digest
+LOG_MAX_PHOTOS_PER_DIGEST = 5  # photo logs per digest, the rest are text-only lines
+LOG_RATE = 0.3  # log channel messages per second (~18/min, under the channel limit)
+LOG_BURST = 3
+LOG_QUEUE_SIZE = 10_000  # log events beyond this are dropped and counted
+PENDING_VIDEOS_MAX = 10  # videos a user can queue while not verified / without thumbnail
+PENDING_SEND_CONCURRENCY = 3  # parallel send_video calls when a queue is flushed
+MEDIA_GROUP_WINDOW = 1.5  # seconds without a new album item before the album is processed
+RATE_LIMIT_GLOBAL = 30  # outgoing messages per second over all chats (Telegram's global limit)
+RATE_LIMIT_CHAT = 1  # messages per second to one private chat, after the burst below
+RATE_LIMIT_CHAT_BURST = 5
+RATE_LIMIT_GROUP = 20 / 60  # messages per second to one group / channel (20 per minute)
+RATE_LIMIT_GROUP_BURST = 3
+RATE_LIMIT_CHATS = 10_000  # per-chat buckets kept (LRU)
+RATE_LIMIT_MAX_RETRIES = 3  # RetryAfter answers retried by the limiter before giving up
+INBOUND_RATE = 1  # updates per second one user may send, after the burst below (owner exempt)
+INBOUND_BURST = 20  # big enough for a 10-video album plus a few commands
+INBOUND_MAX_DELAY = 5  # updates that would wait longer than this for their turn are dropped
+HTTP_POOL_SIZE = 256  # connections for Bot API calls and file downloads
+HTTP_UPDATES_POOL_SIZE = 2  # separate pool for getUpdates long polling
+HTTP_VERSION = "1.1"  # "1.1" or "2" (HTTP/2 needs python-telegram-bot[http2])
+HTTP_CONNECT_TIMEOUT = 5.0
+HTTP_READ_TIMEOUT = 30.0  # seconds to wait for Telegram's answer (long polls add their own timeout)
+HTTP_WRITE_TIMEOUT = 30.0  # seconds to upload a request body (covers are uploaded with send_video)
+HTTP_POOL_TIMEOUT = 10.0  # seconds a call may wait for a free connection before TimedOut
+HTTP_KEEPALIVE_CONNECTIONS = 64  # idle connections kept open per pool
+HTTP_KEEPALIVE_EXPIRY = 30.0  # seconds an idle connection is kept open
+MAX_CONCURRENT_UPDATES = 64  # updates processed in parallel (updates of one user stay sequential)
+RUN_MODE = "polling"  # polling | webhook | sharded (webhook front + SHARDS worker processes)
+SHARDS = 4  # worker processes in sharded mode, updates are routed by user_id % SHARDS
+SHARD_BASE_PORT = 8450  # worker i listens on 127.0.0.1:SHARD_BASE_PORT + i
+BAN_REFRESH_INTERVAL = 5  # seconds between ban list reloads in a shard worker
+WEBHOOK_LISTEN = "0.0.0.0"
+WEBHOOK_PORT = 8443
+WEBHOOK_PATH = "/webhook"
+WEBHOOK_URL = ""  # public https base url behind the reverse proxy; empty = don't call setWebhook
+WEBHOOK_SECRET = ""  # checked against X-Telegram-Bot-Api-Secret-Token when set
+WEBHOOK_MAX_CONNECTIONS = 40  # concurrent connections Telegram may open to the webhook (1-100)
+THUMB_DIR = "thumbs"  # processed covers, <file_unique_id>.jpg
+THUMB_MAX_SIDE = 320  # Telegram thumbnail limits
+THUMB_MAX_BYTES = 200 * 1024
+THUMB_WORKERS = 2  # processes used to resize/re-encode thumbnails
+THUMB_CACHE_DISK_BYTES = 512 * 1024 * 1024  # LRU-evicted budget for THUMB_DIR
+THUMB_CACHE_MEMORY_BYTES = 32 * 1024 * 1024  # in-memory hot tier
+AUTO_COVER = False  # cover videos of users without a thumbnail with a frame of the video (needs ffmpeg)
+AUTO_COVER_BYTES = 4 * 1024 * 1024  # how much of the video is downloaded to find a frame
+AUTO_COVER_CONCURRENCY = 2  # auto covers generated at the same time
+AUTO_COVER_TIMEOUT = 30  # seconds per auto cover (download + ffmpeg)
+FFMPEG_BIN = "ffmpeg"
+METRICS_LISTEN = "127.0.0.1"
+METRICS_PORT = 9100  # Prometheus /metrics endpoint, 0 = disabled
+LOG_FILE = "bot.log"
+LOG_MAX_BYTES = 20 * 1024 * 1024  # rotate LOG_FILE at this size ...
+LOG_ROTATE_WHEN = ""  # ... or by time instead, e.g. "midnight" (TimedRotatingFileHandler)
+LOG_BACKUPS = 5  # rotated files kept
+LOG_JSON = False  # one JSON object per line (with user_id and handler) instead of plain text
+LOG_SAMPLING = {"httpx": 0.01, "apscheduler": 0.1}  # logger -> share of its INFO/DEBUG records kept
+ALLOWED_UPDATES = ["message", "callback_query", "edited_message", "channel_post", "my_chat_member", "chat_member"]
 # ----------------------------------------
 
 # Logging
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s - %(levelname)s - %(name)s - %(message)s",
-    filename="bot.log",
-)
+# Log calls only put the record on a queue (QueueHandler); a QueueListener thread
+# formats and writes it to the rotating LOG_FILE, so logging never blocks the
+# event loop on disk I/O.
+_log_user: ContextVar[Optional[int]] = ContextVar("log_user", default=None)
+_log_handler: ContextVar[Optional[str]] = ContextVar("log_handler", default=None)
+_log_listener: Optional[logging.handlers.QueueListener] = None
+
+
+class LogContextFilter(logging.Filter):
+    """Drops sampled records of LOG_SAMPLING loggers and tags the rest with the current user and handler."""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno < logging.WARNING:
+            rate = LOG_SAMPLING.get(record.name.split(".", 1)[0])
+            if rate is not None and random.random() >= rate:
+                return False
+        record.user_id = _log_user.get()
+        record.handler = _log_handler.get()
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for key in ("user_id", "handler"):
+            value = getattr(record, key, None)
+            if value is not None:
+                entry[key] = value
+        if record.exc_text or record.exc_info:
+            entry["exception"] = record.exc_text or self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class LogQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler.prepare() formats the record, traceback included, into its
+    message. This one only merges the arguments and keeps the traceback as
+    exc_text, so the file handler's formatter still places it (the "exception"
+    key of JsonFormatter, or after the message in text logs).
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        record.message = record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info and not record.exc_text:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        record.exc_info = None  # tracebacks keep frames alive while the record is queued
+        return record
+
+
+def setup_logging(path: str = LOG_FILE) -> None:
+    """Route all logging through a queue to `path` (replaces an earlier setup)."""
+    global _log_listener
+    if _log_listener is not None:
+        _log_listener.stop()
+    if LOG_ROTATE_WHEN:
+        file_handler = logging.handlers.TimedRotatingFileHandler(path, when=LOG_ROTATE_WHEN, backupCount=LOG_BACKUPS, encoding="utf-8")
+    else:
+        file_handler = logging.handlers.RotatingFileHandler(path, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUPS, encoding="utf-8")
+    file_handler.setFormatter(JsonFormatter() if LOG_JSON else logging.Formatter("%(asctime)s - %(levelname)s - %(name)s - %(message)s"))
+    records: "queue.Queue[logging.LogRecord]" = queue.Queue()
+    queue_handler = LogQueueHandler(records)
+    queue_handler.addFilter(LogContextFilter())
+    root = logging.getLogger()
+    root.handlers[:] = [queue_handler]
+    root.setLevel(logging.INFO)
+    _log_listener = logging.handlers.QueueListener(records, file_handler, respect_handler_level=True)
+    _log_listener.start()
+
+
+def stop_logging() -> None:
+    """Write out the queued records and close the log file (registered with atexit)."""
+    if _log_listener is not None:
+        _log_listener.stop()
+
+
+atexit.register(stop_logging)
 logger = logging.getLogger(__name__)
 
 
 # ---------------- Storage helpers ----------------
-def load_data() -> Dict[str, Any]:
-    if not os.path.exists(DATA_FILE):
-        return {"users": {}, "banned": [], "meta": {"total_videos": 0}}
+# Users, banned ids and meta live in an SQLite database in WAL mode. Every user
+# record is one row (JSON encoded), so a state change only upserts that row
+# instead of rewriting the whole data set.
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (id INTEGER PRIMARY KEY, record TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS banned (id INTEGER PRIMARY KEY);
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS broadcasts (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    status_chat_id INTEGER,
+    status_message_id INTEGER,
+    cursor INTEGER NOT NULL DEFAULT 0,
+    sent INTEGER NOT NULL DEFAULT 0,
+    failed INTEGER NOT NULL DEFAULT 0,
+    done INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS assets (name TEXT PRIMARY KEY, source TEXT NOT NULL, file_id TEXT NOT NULL);
+-- last broadcast delivery per user: ok | blocked | deactivated | not_found
+CREATE TABLE IF NOT EXISTS delivery (id INTEGER PRIMARY KEY, status TEXT NOT NULL, updated INTEGER NOT NULL);
+CREATE INDEX IF NOT EXISTS delivery_dead ON delivery (id) WHERE status != 'ok';
+-- one row per user and day (epoch day) with activity
+CREATE TABLE IF NOT EXISTS activity (day INTEGER NOT NULL, id INTEGER NOT NULL, PRIMARY KEY (day, id)) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS users_with_thumbnail ON users (id) WHERE json_extract(record, '$.thumbnail_file_id') IS NOT NULL;
+-- idempotency keys: handled update ids and videos already sent with a cover
+CREATE TABLE IF NOT EXISTS processed (key TEXT PRIMARY KEY, result TEXT NOT NULL, created INTEGER NOT NULL);
+"""
+
+_conn: Optional[sqlite3.Connection] = None
+_conn_lock = threading.RLock()
+SHARD_INDEX: Optional[int] = None  # set in sharded worker processes (see run_worker)
+
+
+def open_conn(timeout: float = 5.0) -> sqlite3.Connection:
+    """A new connection to DB_FILE; `timeout` is how long it waits for other connections' locks."""
+    conn = sqlite3.connect(DB_FILE, check_same_thread=False, isolation_level=None, timeout=timeout)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+
+def get_conn() -> sqlite3.Connection:
+    global _conn
+    if _conn is None:
+        _conn = open_conn()
+        _conn.executescript(_SCHEMA)
+    return _conn
+
+
+@contextmanager
+def transaction():
+    # the connection is shared with the write-behind thread
+    with _conn_lock:
+        conn = get_conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        else:
+            conn.execute("COMMIT")
+
+
+def _dump(value: Any) -> str:
+    return json.dumps(value, separators=(",", ":"))
+
+
+def _write_users(conn: sqlite3.Connection, users: Dict[str, Any]) -> None:
+    conn.executemany(
+        "INSERT INTO users (id, record) VALUES (?, ?) ON CONFLICT(id) DO UPDATE SET record = excluded.record",
+        ((int(uid), _dump(rec)) for uid, rec in users.items()),
+    )
+
+
+def _write_meta(conn: sqlite3.Connection, meta: Dict[str, Any]) -> None:
+    conn.executemany(
+        "INSERT INTO meta (key, value) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+        ((k, _dump(v)) for k, v in meta.items()),
+    )
+
+
+def migrate_json_to_sqlite(json_path: str = DATA_FILE) -> int:
+    """
+    One-shot import of the legacy user_data.json into the SQLite store.
+    Runs only while the users table is still empty; the JSON file is renamed to
+    <name>.migrated afterwards so it is never imported twice. Returns the number of users imported.
+    """
+    if not os.path.exists(json_path):
+        return 0
+    conn = get_conn()
+    if conn.execute("SELECT 1 FROM users LIMIT 1").fetchone():
+        return 0
+    with open(json_path, "r") as f:
+        legacy = json.load(f)
+    users = legacy.get("users", {})
+    with transaction() as conn:
+        _write_users(conn, users)
+        conn.executemany("INSERT OR IGNORE INTO banned (id) VALUES (?)", ((int(uid),) for uid in legacy.get("banned", [])))
+        _write_meta(conn, legacy.get("meta", {}))
+    os.replace(json_path, json_path + ".migrated")
+    logger.info("Migrated %d users from %s to %s", len(users), json_path, DB_FILE)
+    return len(users)
+
+
+def meta_key(key: str) -> str:
+    """Shard workers keep their own counters: "total_videos@<shard>"."""
+    return key if SHARD_INDEX is None else f"{key}@{SHARD_INDEX}"
+
+
+def meta_total(key: str) -> int:
+    """Sum of a counter over the unsharded row and every shard's row."""
+    with _conn_lock:
+        rows = get_conn().execute("SELECT value FROM meta WHERE key = ? OR key LIKE ?", (key, key + "@%")).fetchall()
+    return sum(json.loads(value) for (value,) in rows)
+
+
+_reader: Optional[sqlite3.Connection] = None
+
+
+def fetch_user(user_id: int) -> Optional[Dict[str, Any]]:
+    """Lazy loader of UserRegistry.get, on the event loop: a read connection of its own, so
+    (WAL) it never waits for _conn_lock while the write-behind thread or warm_up use the store."""
+    global _reader
+    if _reader is None:
+        get_conn()  # creates the schema
+        _reader = open_conn()
+    row = _reader.execute("SELECT record FROM users WHERE id = ?", (user_id,)).fetchone()
+    return json.loads(row[0]) if row else None
+
+
+def _shard_filter(shard: Optional[int]) -> Tuple[str, tuple]:
+    return ("", ()) if shard is None else (" AND id % ? = ?", (SHARDS, shard))
+
+
+def load_data(shard: Optional[int] = None, lazy: bool = False) -> "UserRegistry":
+    """
+    Load the store; with `shard` only the users of that shard (user_id % SHARDS).
+    `lazy` only reads bans, meta and the user count: records are fetched on first
+    access and warm_up() loads the rest in the background.
+    """
+    data = UserRegistry()
     try:
-        with open(DATA_FILE, "r") as f:
-            return json.load(f)
+        migrate_json_to_sqlite()
+        conn = get_conn()
+        where, params = _shard_filter(shard)
+        if lazy:
+            data.complete = False
+            data.loader = fetch_user
+            data.stored = conn.execute("SELECT COUNT(*) FROM users WHERE 1" + where, params).fetchone()[0]
+        else:
+            for uid, record in conn.execute("SELECT id, record FROM users WHERE 1" + where, params):
+                data.add(UserRecord.from_dict(data, uid, json.loads(record)))
+        data.banned.update(uid for (uid,) in conn.execute("SELECT id FROM banned"))
+        data.dead.update(uid for (uid,) in conn.execute("SELECT id FROM delivery WHERE status != 'ok'"))
+        suffix = "" if shard is None else f"@{shard}"
+        for key, value in conn.execute("SELECT key, value FROM meta"):
+            if suffix and key.endswith(suffix):
+                data.meta[key[:-len(suffix)]] = json.loads(value)
+            elif not suffix and "@" not in key:
+                data.meta[key] = json.loads(value)
     except Exception as e:
         logger.exception("Failed to load data: %s", e)
-        return {"users": {}, "banned": [], "meta": {"total_videos": 0}}
+    return data
 
 
-def save_data(data: Dict[str, Any]) -> None:
-    try:
-        with open(DATA_FILE, "w") as f:
-            json.dump(data, f, indent=2)
-    except Exception as e:
-        logger.exception("Failed to save data: %s", e)
+async def warm_up(data: "UserRegistry", shard: Optional[int] = None) -> None:
+    """Load every record of a lazily loaded registry, WARMUP_BATCH rows at a time between updates."""
+    loop = asyncio.get_running_loop()
+    where, params = _shard_filter(shard)
+    start = time.perf_counter()
 
+    # its own connection: batches are read in the executor without holding _conn_lock
+    conn = await loop.run_in_executor(None, open_conn)
 
-DB = load_data()
+    def fetch(after: int) -> List[Tuple[int, str]]:
+        return conn.execute(
+            "SELECT id, record FROM users WHERE id > ?" + where + " ORDER BY id LIMIT ?", (after, *params, WARMUP_BATCH)
+        ).fetchall()
 
+    last = -1
+    try:
+        while True:
+            rows = await loop.run_in_executor(None, fetch, last)
+            if not rows:
+                break
+            for uid, record in rows:
+                if uid not in data.users:  # already read on first access, maybe changed since
+                    data.add(UserRecord.from_dict(data, uid, json.loads(record)))
+            last = rows[-1][0]
+            await asyncio.sleep(0)
+    finally:
+        conn.close()
+    data.complete = True
+    data.loader = None
+    logger.info("Loaded %d users in %.1fs", len(data.users), time.perf_counter() - start)
+
+
+def write_data(data: "UserRegistry", user_ids: Optional[Iterable[int]] = None) -> None:
+    """
+    Write `data` to DB_FILE in one transaction. With `user_ids` only those rows
+    (plus meta) are upserted; without it every user row and the ban list are written.
+    """
+    with transaction() as conn:
+        if user_ids is not None:
+            users = data.users
+            records = {uid: users[uid] for uid in user_ids if uid in users}
+        else:
+            records = dict(data.users)
+        _write_users(conn, {uid: rec.to_dict() for uid, rec in records.items()})
+        conn.executemany(
+            "INSERT OR IGNORE INTO activity (day, id) VALUES (?, ?)",
+            ((int(rec.last_activity // 86400), uid) for uid, rec in records.items()),
+        )
+        if user_ids is None:
+            if SHARD_INDEX is None:
+                # shard workers only change bans through ban_user/unban_user
+                conn.execute("DELETE FROM banned")
+                conn.executemany("INSERT INTO banned (id) VALUES (?)", ((uid,) for uid in list(data.banned)))
+        _write_meta(conn, {meta_key(k): v for k, v in list(data.meta.items())})
+
+
+# ---------------- User registry ----------------
+class UserRecord:
+    """
+    One user's state. state and thumbnail_file_id are properties and the pending
+    video queue is only changed through add_pending/take_pending, so the owning
+    registry's indexes and counters stay in sync with every change.
+    """
 
-def ensure_user_record(user_id: int) -> Dict[str, Any]:
-    key = str(user_id)
-    if key not in DB["users"]:
-        DB["users"][key] = {
-            "thumbnail_file_id": None,
-            "state": "idle",  # idle|waiting_for_thumb|waiting_for_edit_thumb|pending_force_check
-            "pending_video": None,  # dict with file_id, caption, entities
+    __slots__ = ("user_id", "_thumbnail_file_id", "thumbnail_unique_id", "_state", "_pending_videos", "last_activity",
+                 "_registry")
+
+    def __init__(self, registry: "UserRegistry", user_id: int):
+        self.user_id = user_id
+        self._thumbnail_file_id: Optional[str] = None
+        self.thumbnail_unique_id: Optional[str] = None  # key of the processed cover under THUMB_DIR
+        self._state = "idle"  # idle|waiting_for_thumb|waiting_for_edit_thumb|pending_force_check|waiting_for_thumb_for_video
+        self._pending_videos: List[Dict[str, Any]] = []  # FIFO of dicts with file_id, file_unique_id, caption, entities
+        self.last_activity = time.time()  # epoch seconds of the user's last update, see sweep_stale_records
+        self._registry = registry
+
+    @classmethod
+    def from_dict(cls, registry: "UserRegistry", user_id: int, d: Dict[str, Any]) -> "UserRecord":
+        rec = cls(registry, user_id)
+        rec._thumbnail_file_id = d.get("thumbnail_file_id")
+        rec.thumbnail_unique_id = d.get("thumbnail_unique_id")
+        rec._state = d.get("state") or "idle"
+        rec._pending_videos = d.get("pending_videos") or []
+        if d.get("pending_video"):  # records written before the queue existed
+            rec._pending_videos.append(d["pending_video"])
+        # records written before timestamps existed count as active now
+        rec.last_activity = d.get("last_activity") or rec.last_activity
+        return rec
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "thumbnail_file_id": self._thumbnail_file_id,
+            "thumbnail_unique_id": self.thumbnail_unique_id,
+            "state": self._state,
+            "pending_videos": list(self._pending_videos),
+            "last_activity": int(self.last_activity),
         }
-        save_data(DB)
-    return DB["users"][key]
+
+    @property
+    def thumbnail_file_id(self) -> Optional[str]:
+        return self._thumbnail_file_id
+
+    @thumbnail_file_id.setter
+    def thumbnail_file_id(self, value: Optional[str]) -> None:
+        self._registry.with_thumbnail += bool(value) - bool(self._thumbnail_file_id)
+        self._thumbnail_file_id = value
+        # a new photo invalidates the processed cover; set thumbnail_unique_id afterwards
+        self.thumbnail_unique_id = None
+
+    @property
+    def state(self) -> str:
+        return self._state
+
+    @state.setter
+    def state(self, value: str) -> None:
+        self._registry._index_state(self.user_id, self._state, value)
+        self._state = value
+
+    @property
+    def pending_videos(self) -> Tuple[Dict[str, Any], ...]:
+        return tuple(self._pending_videos)
+
+    def add_pending(self, video: Dict[str, Any]) -> bool:
+        """Queue a video; False if PENDING_VIDEOS_MAX are already waiting."""
+        if len(self._pending_videos) >= PENDING_VIDEOS_MAX:
+            return False
+        self._pending_videos.append(video)
+        self._registry.pending.add(self.user_id)
+        return True
+
+    def take_pending(self) -> List[Dict[str, Any]]:
+        """Remove and return every queued video, oldest first."""
+        videos, self._pending_videos = self._pending_videos, []
+        self._registry.pending.discard(self.user_id)
+        return videos
+
+
+class UserRegistry:
+    """
+    In-memory user store: records keyed by int user id, bans as a set, secondary
+    indexes (users per non-idle state, users with pending videos) and counters,
+    so every lookup the handlers and stats_cmd do is O(1).
+    While `complete` is False (lazy startup) a record missing from `users` is read
+    with `loader` on first access, and the indexes only cover the loaded records.
+    """
+
+    def __init__(self):
+        self.users: Dict[int, UserRecord] = {}
+        self.banned: Set[int] = set()
+        self.dead: Set[int] = set()  # users broadcasts cannot reach (blocked the bot, deleted account)
+        self.meta: Dict[str, Any] = {"total_videos": 0}
+        self.by_state: Dict[str, Set[int]] = defaultdict(set)  # idle users are not indexed
+        self.pending: Set[int] = set()
+        self.with_thumbnail = 0
+        self.complete = True
+        self.loader: Optional[Callable[[int], Optional[Dict[str, Any]]]] = None
+        self.stored = 0  # users in the store at a lazy startup
+        self.created = 0  # users created since then
+
+    def __len__(self) -> int:
+        return len(self.users) if self.complete else self.stored + self.created
+
+    def __contains__(self, user_id: int) -> bool:
+        return self.get(user_id) is not None
+
+    def get(self, user_id: int) -> Optional[UserRecord]:
+        rec = self.users.get(user_id)
+        if rec is None and not self.complete:
+            d = self.loader(user_id)
+            if d is not None:
+                rec = UserRecord.from_dict(self, user_id, d)
+                self.add(rec)
+        return rec
+
+    def create(self, user_id: int) -> UserRecord:
+        rec = UserRecord(self, user_id)
+        self.add(rec)
+        self.created += 1
+        return rec
+
+    def add(self, rec: UserRecord) -> None:
+        self.users[rec.user_id] = rec
+        self._index_state(rec.user_id, "idle", rec.state)
+        if rec.pending_videos:
+            self.pending.add(rec.user_id)
+        if rec.thumbnail_file_id:
+            self.with_thumbnail += 1
+
+    def _index_state(self, user_id: int, old: str, new: str) -> None:
+        if old == new:
+            return
+        if old != "idle":
+            users = self.by_state[old]
+            users.discard(user_id)
+            if not users:
+                del self.by_state[old]
+        if new != "idle":
+            self.by_state[new].add(user_id)
+
+    def incr(self, key: str, n: int = 1) -> None:
+        self.meta[key] = self.meta.get(key, 0) + n
+
+
+# ---------------- Write-behind persistence ----------------
+class WriteBehind:
+    """
+    Collects dirty user ids and writes them from a background thread, so handlers
+    never wait on disk I/O. Many changes to the same user between two flushes
+    collapse into a single row upsert. Other stores that buffer rows (see
+    IdempotencyCache) register a flusher that runs with every flush.
+    """
+
+    def __init__(self, data: UserRegistry, interval: float, max_dirty: int):
+        self.data = data
+        self.interval = interval
+        self.max_dirty = max_dirty
+        self._dirty: Set[int] = set()
+        self._full = False
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopping = False
+        self._thread: Optional[threading.Thread] = None
+        self._flushers: List[Callable[[], None]] = []
+
+    def add_flusher(self, flush: Callable[[], None]) -> None:
+        self._flushers.append(flush)
+
+    def mark_dirty(self, user_id: Optional[int] = None) -> None:
+        with self._lock:
+            if user_id is None:
+                self._full = True
+            else:
+                self._dirty.add(user_id)
+            pending = len(self._dirty)
+        self.start()
+        if pending >= self.max_dirty:
+            self._wake.set()
+
+    def pending(self) -> int:
+        return len(self._dirty)
+
+    def start(self) -> None:
+        with self._lock:
+            if self._thread is not None or self._stopping:
+                return
+            self._thread = threading.Thread(target=self._run, name="write-behind", daemon=True)
+        self._thread.start()
+
+    def _run(self) -> None:
+        while not self._stopping:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            self.flush()
+
+    def flush(self) -> None:
+        for flush in self._flushers:
+            flush()
+        with self._lock:
+            dirty, full = self._dirty, self._full
+            self._dirty, self._full = set(), False
+        if not dirty and not full:
+            return
+        try:
+            write_data(self.data, None if full else dirty)
+        except Exception as e:
+            logger.exception("Failed to save data: %s", e)
+            # keep the records dirty so the next flush retries them
+            with self._lock:
+                self._dirty |= dirty
+                self._full = self._full or full
+
+    def stop(self) -> None:
+        """Stop the flusher thread and write whatever is still dirty."""
+        self._stopping = True
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
+
+
+# Empty until init_process() loads the store: shard workers are spawned and
+# re-import this module, so nothing is opened or loaded at import time.
+DB = UserRegistry()
+PERSISTENCE = WriteBehind(DB, FLUSH_INTERVAL, FLUSH_MAX_DIRTY)
+atexit.register(PERSISTENCE.stop)
+
+
+def init_process(log_path: str = LOG_FILE, shard: Optional[int] = None) -> None:
+    """Per-process setup done by main() and run_worker(): open the log file and load the store."""
+    global DB
+    setup_logging(log_path)
+    DB = load_data(shard=shard, lazy=LAZY_LOAD)
+    PERSISTENCE.data = DB
+
+
+def save_data(data: UserRegistry, user_id: Optional[int] = None) -> None:
+    """
+    Schedule `data` for persistence. Returns immediately; the write-behind thread
+    upserts the user's row (or everything, without `user_id`) on its next flush.
+    """
+    PERSISTENCE.mark_dirty(user_id)
+
+
+def ensure_user_record(user_id: int) -> UserRecord:
+    rec = DB.get(user_id)
+    if rec is None:
+        rec = DB.create(user_id)
+        save_data(DB, user_id)
+    else:
+        now = time.time()
+        if int(now // 86400) != int(rec.last_activity // 86400):
+            save_data(DB, user_id)  # records the day in the activity table
+        # otherwise persisted with the record's next change
+        rec.last_activity = now
+    if user_id in DB.dead:
+        # the user reached the bot again, so broadcasts can reach them too
+        record_deliveries({user_id: "ok"})
+    return rec
+
+
+_deliveries: Dict[int, Tuple[str, int]] = {}  # user id -> (status, updated), written by the write-behind thread
+_deliveries_lock = threading.Lock()
+
+
+def record_deliveries(outcomes: Dict[int, str]) -> None:
+    """
+    Record broadcast delivery outcomes; anything but "ok" marks the user dead for
+    later broadcasts. Returns immediately, the delivery table is written on the
+    next write-behind flush.
+    """
+    for uid, status in outcomes.items():
+        if status == "ok":
+            DB.dead.discard(uid)
+        else:
+            DB.dead.add(uid)
+    now = int(time.time())
+    with _deliveries_lock:
+        for uid, status in outcomes.items():
+            _deliveries[uid] = (status, now)
+    PERSISTENCE.start()
+
+
+def flush_deliveries() -> None:
+    global _deliveries
+    with _deliveries_lock:
+        rows, _deliveries = _deliveries, {}
+    if not rows:
+        return
+    try:
+        with transaction() as conn:
+            conn.executemany(
+                "INSERT INTO delivery (id, status, updated) VALUES (?, ?, ?) "
+                "ON CONFLICT(id) DO UPDATE SET status = excluded.status, updated = excluded.updated",
+                ((uid, status, updated) for uid, (status, updated) in rows.items()),
+            )
+    except Exception as e:
+        logger.exception("Failed to save delivery outcomes: %s", e)
+        with _deliveries_lock:
+            for uid, row in rows.items():
+                _deliveries.setdefault(uid, row)
+
+
+PERSISTENCE.add_flusher(flush_deliveries)
 
 
 def is_banned(user_id: int) -> bool:
-    return str(user_id) in DB.get("banned", [])
+    return user_id in DB.banned
 
 
 def ban_user(user_id: int) -> None:
-    DB.setdefault("banned", [])
-    if str(user_id) not in DB["banned"]:
-        DB["banned"].append(str(user_id))
-        save_data(DB)
+    if user_id not in DB.banned:
+        DB.banned.add(user_id)
+        try:
+            with transaction() as conn:
+                conn.execute("INSERT OR IGNORE INTO banned (id) VALUES (?)", (user_id,))
+        except Exception as e:
+            logger.exception("Failed to save ban: %s", e)
 
 
 def unban_user(user_id: int) -> None:
-    if str(user_id) in DB.get("banned", []):
-        DB["banned"].remove(str(user_id))
-        save_data(DB)
+    if user_id in DB.banned:
+        DB.banned.discard(user_id)
+        try:
+            with transaction() as conn:
+                conn.execute("DELETE FROM banned WHERE id = ?", (user_id,))
+        except Exception as e:
+            logger.exception("Failed to save unban: %s", e)
+
+
+# ---------------- Stale state sweeper ----------------
+def sweep_stale_records(data: UserRegistry, now: Optional[float] = None) -> Tuple[int, int]:
+    """
+    Reset states older than STATE_TTL to idle and drop video queues older than
+    PENDING_TTL (age = time since the user's last update). Only walks the
+    non-idle and pending indexes. Returns (states expired, queues dropped).
+    """
+    now = now or time.time()
+    states = queues = 0
+    for uid in list(data.pending):
+        rec = data.users[uid]
+        if now - rec.last_activity > PENDING_TTL:
+            rec.take_pending()
+            queues += 1
+            save_data(data, uid)
+    for state, uids in list(data.by_state.items()):
+        for uid in list(uids):
+            rec = data.users[uid]
+            if now - rec.last_activity > STATE_TTL:
+                rec.state = "idle"
+                states += 1
+                save_data(data, uid)
+    return states, queues
+
+
+def _store_bytes() -> int:
+    return sum(os.path.getsize(p) for p in (DB_FILE, DB_FILE + "-wal") if os.path.exists(p))
+
+
+def compact_store() -> int:
+    """Write pending changes, truncate the WAL and VACUUM when enough pages are free. Returns bytes reclaimed."""
+    PERSISTENCE.flush()
+    before = _store_bytes()
+    with transaction() as conn:
+        conn.execute("DELETE FROM activity WHERE day < ?", (int(time.time() // 86400) - ACTIVITY_DAYS,))
+        conn.execute(
+            "DELETE FROM processed WHERE created < ? OR rowid <= (SELECT MAX(rowid) FROM processed) - ?",
+            (int(time.time()) - IDEMPOTENCY_TTL, IDEMPOTENCY_CACHE_SIZE),
+        )
+    # not under _conn_lock: a long VACUUM must not stall the event loop, which takes that
+    # lock for short writes; SQLite's own locking serializes this connection with the others
+    conn = open_conn(timeout=60)
+    try:
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        free = conn.execute("PRAGMA freelist_count").fetchone()[0] * conn.execute("PRAGMA page_size").fetchone()[0]
+        if free >= SWEEP_VACUUM_MIN_BYTES:
+            conn.execute("VACUUM")
+            conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    finally:
+        conn.close()
+    return max(0, before - _store_bytes())
+
+
+async def sweep_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    start = time.perf_counter()
+    states, queues = sweep_stale_records(DB)
+    # the store is shared: one shard compacts it
+    reclaimed = 0
+    if SHARD_INDEX in (None, 0):
+        try:
+            reclaimed = await asyncio.get_running_loop().run_in_executor(None, compact_store)
+        except Exception as e:
+            logger.warning("Store compaction failed: %s", e)
+    METRICS.inc("bot_sweeper_expired_total", "Records reset by the stale state sweeper.", states, kind="state")
+    METRICS.inc("bot_sweeper_expired_total", "Records reset by the stale state sweeper.", queues, kind="pending_videos")
+    METRICS.inc("bot_sweeper_reclaimed_bytes_total", "Bytes of DB_FILE reclaimed by compaction.", reclaimed)
+    logger.info("Sweep: %d states expired, %d video queues dropped, %d bytes reclaimed in %.1fs",
+                states, queues, reclaimed, time.perf_counter() - start)
+    if states or queues or reclaimed:
+        LOGS.put(
+            "Stale state sweep",
+            f"States expired: <code>{states}</code>\n"
+            f"Video queues dropped: <code>{queues}</code>\n"
+            f"Bytes reclaimed: <code>{reclaimed}</code>\n",
+        )
+
+
+# ---------------- Export / import ----------------
+# python bot.py export <file>   /   python bot.py import <file>
+# .csv files use CSV_FIELDS (users and bans); anything else is JSON Lines: a
+# {"meta": {...}} line followed by one {"id", "banned", "record"} line per user.
+# Rows are streamed in both directions, so memory use does not grow with the
+# number of users. Import upserts into DB_FILE; run it while the bot is stopped.
+CSV_FIELDS = ("id", "banned", "state", "thumbnail_file_id", "thumbnail_unique_id", "pending_videos", "last_activity")
+
+
+def _export_rows() -> Iterable[Tuple[int, bool, Optional[Dict[str, Any]]]]:
+    conn = get_conn()
+    # through UserRecord, so rows in an older layout (e.g. migrated "pending_video") export like current ones
+    yield from (
+        (uid, bool(banned), UserRecord.from_dict(DB, uid, json.loads(record)).to_dict())
+        for uid, record, banned in conn.execute(
+            "SELECT u.id, u.record, b.id IS NOT NULL FROM users u LEFT JOIN banned b ON b.id = u.id ORDER BY u.id"
+        )
+    )
+    # bans of users without a record
+    yield from ((uid, True, None) for (uid,) in conn.execute(
+        "SELECT id FROM banned WHERE id NOT IN (SELECT id FROM users) ORDER BY id"
+    ))
+
+
+def export_data(path: str) -> int:
+    PERSISTENCE.flush()
+    n = 0
+    with _conn_lock, open(path, "w", newline="", encoding="utf-8") as f:
+        if path.endswith(".csv"):
+            writer = csv.writer(f)
+            writer.writerow(CSV_FIELDS)
+            for uid, banned, record in _export_rows():
+                if record is None:
+                    writer.writerow([uid, int(banned), "", "", "", "", ""])
+                else:
+                    writer.writerow([
+                        uid, int(banned), record["state"], record["thumbnail_file_id"] or "",
+                        record["thumbnail_unique_id"] or "", _dump(record["pending_videos"]), record["last_activity"],
+                    ])
+                n += 1
+        else:
+            meta = dict(get_conn().execute("SELECT key, value FROM meta").fetchall())
+            f.write(_dump({"meta": {k: json.loads(v) for k, v in meta.items()}}) + "\n")
+            for uid, banned, record in _export_rows():
+                f.write(_dump({"id": uid, "banned": banned, "record": record}) + "\n")
+                n += 1
+    return n
+
+
+def _import_rows(f) -> Iterable[Tuple[int, bool, Optional[Dict[str, Any]]]]:
+    if f.name.endswith(".csv"):
+        for row in csv.DictReader(f):
+            record = None
+            if row.get("state"):
+                record = {
+                    "thumbnail_file_id": row.get("thumbnail_file_id") or None,
+                    "thumbnail_unique_id": row.get("thumbnail_unique_id") or None,
+                    "state": row["state"],
+                    "pending_videos": json.loads(row.get("pending_videos") or "[]"),
+                    "last_activity": int(row["last_activity"]) if row.get("last_activity") else None,
+                }
+            yield int(row["id"]), row.get("banned") in ("1", "true", "True"), record
+        return
+    for line in f:
+        if not line.strip():
+            continue
+        item = json.loads(line)
+        if "meta" in item:
+            with transaction() as conn:
+                _write_meta(conn, item["meta"])
+            continue
+        yield int(item["id"]), bool(item.get("banned")), item.get("record")
+
+
+def _import_batch(batch: List[Tuple[int, bool, Optional[Dict[str, Any]]]]) -> None:
+    with transaction() as conn:
+        _write_users(conn, {uid: record for uid, _, record in batch if record is not None})
+        conn.executemany("INSERT OR IGNORE INTO banned (id) VALUES (?)", ((uid,) for uid, banned, _ in batch if banned))
+        conn.executemany("DELETE FROM banned WHERE id = ?", ((uid,) for uid, banned, _ in batch if not banned))
+
+
+def import_data(path: str) -> int:
+    n = 0
+    batch = []
+    with open(path, "r", newline="", encoding="utf-8") as f:
+        for row in _import_rows(f):
+            batch.append(row)
+            if len(batch) >= IMPORT_BATCH:
+                _import_batch(batch)
+                n += len(batch)
+                batch = []
+    if batch:
+        _import_batch(batch)
+        n += len(batch)
+    return n
 
 
 # ---------------- Keyboards ----------------
@@ -174,27 +1049,839 @@ def raw_to_entities(raw: Optional[List[Dict[str, Any]]]) -> Optional[List[Messag
     return res
 
 
+class TokenBucket:
+    """
+    Async token bucket: `rate` tokens per second, bursts up to `capacity`.
+    pause() stops all acquirers for a while (used when Telegram answers RetryAfter).
+    """
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def pause(self, seconds: float) -> None:
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    async def acquire(self) -> None:
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                self._refill(now)
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+# ---------------- Outbound rate limiting ----------------
+# Every message-sending Bot API call goes through PriorityRateLimiter. Callers
+# pass their class as rate_limit_args; plain handler calls are user replies.
+PRIORITY_USER = 0
+PRIORITY_LOG = 1
+PRIORITY_BROADCAST = 2
+_PRIORITY_NAMES = {PRIORITY_USER: "user", PRIORITY_LOG: "log", PRIORITY_BROADCAST: "broadcast"}
+_LIMITED_METHODS = ("send", "copy", "forward", "edit")
+
+
+class PriorityBucket(TokenBucket):
+    """
+    Token bucket whose waiters are served by priority (lowest value first),
+    in arrival order within one class.
+    """
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        super().__init__(rate, capacity)
+        self._waiters: List[Tuple[int, int, asyncio.Future]] = []
+        self._seq = itertools.count()
+        self._pump_task: Optional[asyncio.Task] = None
+
+    def _take(self) -> float:
+        """Take a token if one is available; otherwise return how long to wait for one."""
+        now = time.monotonic()
+        if now < self.paused_until:
+            return self.paused_until - now
+        self._refill(now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    async def acquire(self, priority: int = PRIORITY_USER) -> None:
+        if not self._waiters and not self._take():
+            return
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._seq), future))
+        if self._pump_task is None or self._pump_task.done():
+            self._pump_task = asyncio.create_task(self._pump())
+        await future
+
+    async def _pump(self) -> None:
+        while self._waiters:
+            if self._waiters[0][2].done():  # waiter was cancelled
+                heapq.heappop(self._waiters)
+                continue
+            wait = self._take()
+            if wait:
+                await asyncio.sleep(wait)
+                continue
+            heapq.heappop(self._waiters)[2].set_result(None)
+
+
+class PriorityRateLimiter(BaseRateLimiter):
+    """
+    Keeps sends under Telegram's global and per-chat limits. Requests wait for
+    their chat's bucket first, then for the shared global bucket, where user
+    replies go before log messages and log messages before broadcasts.
+    RetryAfter pauses the affected bucket and the request is tried again.
+    """
+
+    def __init__(self):
+        self.global_bucket = PriorityBucket(RATE_LIMIT_GLOBAL)
+        self.chats: "OrderedDict[Any, TokenBucket]" = OrderedDict()
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    def _chat_bucket(self, chat_id: Any) -> TokenBucket:
+        bucket = self.chats.get(chat_id)
+        if bucket is None:
+            group = isinstance(chat_id, str) or int(chat_id) < 0
+            bucket = TokenBucket(RATE_LIMIT_GROUP, RATE_LIMIT_GROUP_BURST) if group else TokenBucket(RATE_LIMIT_CHAT, RATE_LIMIT_CHAT_BURST)
+            self.chats[chat_id] = bucket
+            if len(self.chats) > RATE_LIMIT_CHATS:
+                self.chats.popitem(last=False)
+        else:
+            self.chats.move_to_end(chat_id)
+        return bucket
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        if not endpoint.startswith(_LIMITED_METHODS):
+            return await callback(*args, **kwargs)
+        priority = PRIORITY_USER if rate_limit_args is None else rate_limit_args
+        chat_id = data.get("chat_id")
+        chat_bucket = self._chat_bucket(chat_id) if chat_id is not None else None
+        for attempt in range(RATE_LIMIT_MAX_RETRIES + 1):
+            start = time.perf_counter()
+            if chat_bucket:
+                await chat_bucket.acquire()
+            await self.global_bucket.acquire(priority)
+            METRICS.observe("bot_rate_limit_wait_seconds", "Time sends waited for the rate limiter.",
+                            time.perf_counter() - start, priority=_PRIORITY_NAMES.get(priority, priority))
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                METRICS.inc("bot_retry_after_total", "RetryAfter answers by method.", method=endpoint)
+                if attempt == RATE_LIMIT_MAX_RETRIES:
+                    raise
+                logger.warning("%s to %s: flood wait %ss", endpoint, chat_id, e.retry_after)
+                (chat_bucket or self.global_bucket).pause(e.retry_after)
+
+
+# ---------------- Log channel pipeline ----------------
+class LogPipeline:
+    """
+    Handlers only enqueue log events; a background task drains the queue every
+    LOG_DIGEST_INTERVAL seconds. Up to LOG_MAX_PHOTOS_PER_DIGEST events are sent
+    as photo logs, everything else is folded into one digest message. Sends are
+    paced by their own token bucket so logging cannot eat into user traffic.
+    """
+
+    def __init__(self):
+        # None is stop()'s wake-up call
+        self.queue: "asyncio.Queue[Optional[Tuple[str, str, Optional[str]]]]" = asyncio.Queue(maxsize=LOG_QUEUE_SIZE)
+        self.bucket = TokenBucket(LOG_RATE, capacity=LOG_BURST)
+        self.dropped = 0
+        self._task: Optional[asyncio.Task] = None
+        self._stopping = asyncio.Event()
+
+    def put(self, title: str, body: str, photo_file_id: Optional[str] = None) -> None:
+        try:
+            self.queue.put_nowait((title, body, photo_file_id))
+        except asyncio.QueueFull:
+            self.dropped += 1
+
+    def start(self, bot) -> None:
+        if self._task is None:
+            self._stopping.clear()
+            self._task = asyncio.create_task(self._run(bot), name="log-pipeline")
+
+    async def stop(self, bot) -> None:
+        """Deliver everything queued or collected for the next digest, then end the task."""
+        if self._task is None:
+            return
+        self._stopping.set()
+        with contextlib.suppress(asyncio.QueueFull):
+            self.queue.put_nowait(None)  # wakes _run if it is waiting for the first event
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+
+    def _drain(self) -> List[Tuple[str, str, Optional[str]]]:
+        events = []
+        while not self.queue.empty():
+            event = self.queue.get_nowait()
+            if event is not None:
+                events.append(event)
+        return events
+
+    async def _run(self, bot) -> None:
+        # not cancelled by stop(): events taken from the queue are always flushed
+        while True:
+            first = await self.queue.get()
+            if first is not None and not self._stopping.is_set():
+                with contextlib.suppress(asyncio.TimeoutError):
+                    await asyncio.wait_for(self._stopping.wait(), LOG_DIGEST_INTERVAL)
+            events = ([first] if first is not None else []) + self._drain()
+            await self._flush(bot, events)
+            if self._stopping.is_set():
+                return
+
+    async def _send(self, call, **kwargs) -> None:
+        await self.bucket.acquire()
+        try:
+            await call(chat_id=LOG_CHANNEL_ID, parse_mode=constants.ParseMode.HTML, rate_limit_args=PRIORITY_LOG, **kwargs)
+        except RetryAfter as e:
+            self.bucket.pause(e.retry_after + 1)
+            logger.warning("Log channel flood wait %ss", e.retry_after)
+        except Exception as e:
+            logger.warning("Failed to send log: %s", e)
+
+    async def _flush(self, bot, events: List[Tuple[str, str, Optional[str]]]) -> None:
+        rest = []
+        photos = 0
+        for title, body, photo_file_id in events:
+            if photo_file_id and photos < LOG_MAX_PHOTOS_PER_DIGEST:
+                photos += 1
+                await self._send(bot.send_photo, photo=photo_file_id, caption=f"<b>{html.escape(title)}</b>\n\n{body}")
+            else:
+                rest.append(f"<b>{html.escape(title)}</b>\n{body}")
+        if self.dropped:
+            rest.append(f"<i>{self.dropped} log events dropped (queue full)</i>")
+            self.dropped = 0
+        if not rest:
+            return
+        header = f"<b>Log digest</b> ({len(rest)} events)\n\n" if len(rest) > 1 else ""
+        text = header
+        for entry in rest:
+            if len(text) + len(entry) + 2 > constants.MessageLimit.MAX_TEXT_LENGTH:
+                await self._send(bot.send_message, text=text)
+                text = ""
+            text += entry + "\n\n"
+        await self._send(bot.send_message, text=text)
+
+
+LOGS = LogPipeline()
+
+
 async def send_log(context: ContextTypes.DEFAULT_TYPE, title: str, body: str, photo_file_id: Optional[str] = None):
     """
-    Send a nicer log message to LOG_CHANNEL_ID. If photo provided, send photo with caption.
+    Queue a nicer log message for LOG_CHANNEL_ID (with the photo, if provided).
+    Returns immediately; the log pipeline delivers it in the background.
+    """
+    LOGS.put(title, body, photo_file_id)
+
+
+# ---------------- Thumbnails ----------------
+# Telegram only honours a video thumbnail that is an uploaded JPEG of at most
+# 200 kB and 320 px per side; a photo file_id passed as thumb is silently ignored.
+# The user's photo is therefore downloaded once, re-encoded in a process pool and
+# kept in the thumbnail cache, keyed by the photo's file_unique_id.
+_thumb_pool: Optional[ProcessPoolExecutor] = None
+
+
+def get_thumb_pool() -> ProcessPoolExecutor:
+    global _thumb_pool
+    if _thumb_pool is None:
+        _thumb_pool = ProcessPoolExecutor(max_workers=THUMB_WORKERS)
+    return _thumb_pool
+
+
+def normalize_thumbnail(data: bytes) -> bytes:
+    """Re-encode an image as an RGB JPEG within THUMB_MAX_SIDE px and THUMB_MAX_BYTES (runs in the pool)."""
+    img = Image.open(io.BytesIO(data))
+    img = img.convert("RGB")
+    img.thumbnail((THUMB_MAX_SIDE, THUMB_MAX_SIDE), Image.LANCZOS)
+    while True:
+        for quality in (90, 80, 70, 60, 50, 40):
+            buf = io.BytesIO()
+            img.save(buf, "JPEG", quality=quality, optimize=True)
+            if buf.tell() <= THUMB_MAX_BYTES:
+                return buf.getvalue()
+        img = img.resize((max(1, img.width * 3 // 4), max(1, img.height * 3 // 4)), Image.LANCZOS)
+
+
+class ThumbCache:
+    """
+    Processed covers keyed by the photo's file_unique_id: JPEG files under THUMB_DIR
+    with a byte budget and LRU eviction, plus an in-memory hot tier for the most
+    recently used covers. All bookkeeping happens on the event loop, file I/O in
+    the default executor.
     """
+
+    def __init__(self, directory: str, disk_budget: int, memory_budget: int):
+        self.directory = directory
+        self.disk_budget = disk_budget
+        self.memory_budget = memory_budget
+        self.hits = 0
+        self.misses = 0
+        self._disk: "OrderedDict[str, int]" = OrderedDict()  # unique_id -> size, LRU order
+        self._disk_bytes = 0
+        self._hot: "OrderedDict[str, bytes]" = OrderedDict()
+        self._hot_bytes = 0
+        self._loading: Optional[asyncio.Future] = None
+
+    def path(self, unique_id: str) -> str:
+        return os.path.join(self.directory, f"{unique_id}.jpg")
+
+    def load(self) -> "asyncio.Future":
+        """Index the files already in the directory; post_init starts it, get() and put() wait for it."""
+        if self._loading is None:
+            self._loading = asyncio.ensure_future(self._load())
+        return self._loading
+
+    async def _load(self) -> None:
+        try:
+            entries = await asyncio.get_running_loop().run_in_executor(None, _scan_covers, self.directory)
+        except OSError as e:
+            logger.warning("Failed to index %s: %s", self.directory, e)
+            return
+        for unique_id, size in entries:
+            self._disk[unique_id] = size
+            self._disk_bytes += size
+
+    def _remember_hot(self, unique_id: str, data: bytes) -> None:
+        old = self._hot.pop(unique_id, None)
+        if old is not None:
+            self._hot_bytes -= len(old)
+        self._hot[unique_id] = data
+        self._hot_bytes += len(data)
+        while self._hot_bytes > self.memory_budget and len(self._hot) > 1:
+            _, evicted = self._hot.popitem(last=False)
+            self._hot_bytes -= len(evicted)
+
+    async def get(self, unique_id: str) -> Optional[bytes]:
+        await self.load()
+        data = self._hot.get(unique_id)
+        if data is not None:
+            self.hits += 1
+            self._hot.move_to_end(unique_id)
+            if unique_id in self._disk:
+                self._disk.move_to_end(unique_id)
+            return data
+        if unique_id in self._disk:
+            try:
+                data = await asyncio.get_running_loop().run_in_executor(None, _read_and_touch, self.path(unique_id))
+            except OSError:
+                self._forget(unique_id)
+            else:
+                self.hits += 1
+                if unique_id in self._disk:
+                    self._disk.move_to_end(unique_id)
+                self._remember_hot(unique_id, data)
+                return data
+        self.misses += 1
+        return None
+
+    async def put(self, unique_id: str, data: bytes) -> None:
+        await self.load()
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, _write_file, self.path(unique_id), data)
+        self._forget(unique_id)
+        self._disk[unique_id] = len(data)
+        self._disk_bytes += len(data)
+        self._remember_hot(unique_id, data)
+        evicted = []
+        while self._disk_bytes > self.disk_budget and len(self._disk) > 1:
+            old_id, size = self._disk.popitem(last=False)
+            self._disk_bytes -= size
+            old = self._hot.pop(old_id, None)
+            if old is not None:
+                self._hot_bytes -= len(old)
+            evicted.append(self.path(old_id))
+        if evicted:
+            await loop.run_in_executor(None, _remove_files, evicted)
+
+    def _forget(self, unique_id: str) -> None:
+        size = self._disk.pop(unique_id, None)
+        if size is not None:
+            self._disk_bytes -= size
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "files": len(self._disk),
+            "disk_bytes": self._disk_bytes,
+            "memory_bytes": self._hot_bytes,
+        }
+
+
+def _scan_covers(directory: str) -> List[Tuple[str, int]]:
+    """(unique_id, size) of the covers in `directory`, least recently used first (files are touched on every disk hit)."""
+    if not os.path.isdir(directory):
+        return []
+    entries = []
+    for entry in os.scandir(directory):
+        if entry.name.endswith(".jpg"):
+            st = entry.stat()
+            entries.append((st.st_mtime, entry.name[:-4], st.st_size))
+    return [(unique_id, size) for _, unique_id, size in sorted(entries)]
+
+
+def _write_file(path: str, data: bytes) -> None:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+def _read_and_touch(path: str) -> bytes:
+    with open(path, "rb") as f:
+        data = f.read()
+    os.utime(path)  # keeps the LRU order across restarts
+    return data
+
+
+def _remove_files(paths: List[str]) -> None:
+    for path in paths:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+THUMBS = ThumbCache(THUMB_DIR, THUMB_CACHE_DISK_BYTES, THUMB_CACHE_MEMORY_BYTES)
+
+
+async def process_thumbnail(bot, file_id: str, unique_id: str, tg_file=None) -> Optional[bytes]:
+    """
+    Download a photo, normalize it off the event loop and store the result.
+    `tg_file` is the photo's File when the caller already has it.
+    Returns the JPEG bytes, or None if Pillow is missing or processing failed.
+    """
+    if Image is None:
+        return None
+    loop = asyncio.get_running_loop()
+    try:
+        tg_file = tg_file or await bot.get_file(file_id)
+        raw = bytes(await tg_file.download_as_bytearray())
+        data = await loop.run_in_executor(get_thumb_pool(), normalize_thumbnail, raw)
+        await THUMBS.put(unique_id, data)
+        return data
+    except Exception as e:
+        logger.warning("Failed to process thumbnail %s: %s", unique_id, e)
+        return None
+
+
+async def get_cover(bot, rec: "UserRecord") -> Union[bytes, str, None]:
+    """
+    What to pass as send_video(thumbnail=...): the cached processed JPEG when there is
+    one (re-created on a cache miss), otherwise the raw photo file_id.
+    """
+    if not rec.thumbnail_file_id:
+        return None
+    if rec.thumbnail_unique_id:
+        data = await THUMBS.get(rec.thumbnail_unique_id)
+        if data is None:
+            data = await process_thumbnail(bot, rec.thumbnail_file_id, rec.thumbnail_unique_id)
+        if data:
+            return data
+    elif Image is not None:
+        # saved without a processed cover (migrated from user_data.json, or processing
+        # failed in handle_photo): getFile gives the unique id, then it is cached as usual
+        try:
+            tg_file = await bot.get_file(rec.thumbnail_file_id)
+        except Exception as e:
+            logger.warning("Failed to look up thumbnail %s: %s", rec.thumbnail_file_id, e)
+            return rec.thumbnail_file_id
+        unique_id = tg_file.file_unique_id
+        data = await THUMBS.get(unique_id) or await process_thumbnail(bot, rec.thumbnail_file_id, unique_id, tg_file)
+        if data:
+            rec.thumbnail_unique_id = unique_id
+            save_data(DB, rec.user_id)
+            return data
+    return rec.thumbnail_file_id
+
+
+# ---------------- Auto cover ----------------
+# With AUTO_COVER on, a user without a saved thumbnail gets a cover taken from the
+# video itself: only the first AUTO_COVER_BYTES of the file are downloaded and
+# ffmpeg picks a representative frame from them in the thumbnail process pool.
+# This needs the video's index at the start of the file (e.g. "faststart" MP4s)
+# and getFile only serves files up to 20 MB; otherwise the user is asked for a photo.
+_auto_cover_slots = asyncio.Semaphore(AUTO_COVER_CONCURRENCY)
+
+
+def extract_keyframe(path: str) -> bytes:
+    """Grab a representative frame of a (partial) video with ffmpeg, as a normalized JPEG (runs in the pool)."""
+    result = subprocess.run(
+        [
+            FFMPEG_BIN, "-v", "error", "-i", path,
+            "-vf", "thumbnail", "-frames:v", "1",
+            "-f", "image2pipe", "-vcodec", "png", "pipe:1",
+        ],
+        capture_output=True,
+        timeout=AUTO_COVER_TIMEOUT,
+        check=True,
+    )
+    return normalize_thumbnail(result.stdout)
+
+
+async def _download_head(url: str, path: str) -> None:
+    async with httpx.AsyncClient(timeout=AUTO_COVER_TIMEOUT) as client:
+        async with client.stream("GET", url, headers={"Range": f"bytes=0-{AUTO_COVER_BYTES - 1}"}) as resp:
+            resp.raise_for_status()
+            received = 0
+            with open(path, "wb") as f:
+                async for chunk in resp.aiter_bytes():
+                    f.write(chunk[:AUTO_COVER_BYTES - received])
+                    received += len(chunk)
+                    if received >= AUTO_COVER_BYTES:
+                        break
+
+
+async def _make_auto_cover(bot, file_id: str) -> bytes:
+    tg_file = await bot.get_file(file_id)
+    fd, path = tempfile.mkstemp(suffix=".part")
+    os.close(fd)
     try:
-        if photo_file_id:
-            # send photo first with caption
-            await context.bot.send_photo(
-                chat_id=LOG_CHANNEL_ID,
-                photo=photo_file_id,
-                caption=f"<b>{html.escape(title)}</b>\n\n{body}",
+        await _download_head(tg_file.file_path, path)
+        return await asyncio.get_running_loop().run_in_executor(get_thumb_pool(), extract_keyframe, path)
+    finally:
+        os.remove(path)
+
+
+async def auto_cover(bot, file_id: str, unique_id: Optional[str]) -> Optional[bytes]:
+    """Cover generated from the video's first megabytes, or None (disabled, unsupported or failed)."""
+    if not AUTO_COVER or Image is None:
+        return None
+    key = f"auto_{unique_id}" if unique_id else None
+    if key:
+        cached = await THUMBS.get(key)
+        if cached:
+            return cached
+    async with _auto_cover_slots:
+        try:
+            data = await asyncio.wait_for(_make_auto_cover(bot, file_id), AUTO_COVER_TIMEOUT)
+        except Exception as e:
+            logger.warning("Auto cover failed for %s: %r", file_id, e)
+            return None
+    if key:
+        await THUMBS.put(key, data)
+    return data
+
+
+# ---------------- Idempotency cache ----------------
+class IdempotencyCache:
+    """
+    Work that is already done, so it is not done twice: "update:<update_id>" for
+    handled updates (run_polling redelivers them after a restart or a network
+    error) and "video:<user>:<file_unique_id>:<cover>" -> {"message_id"} for
+    videos sent with a cover. The newest `size` entries are kept in memory (LRU)
+    and in the processed table: new entries are written by the write-behind
+    thread, and post_init loads the table before updates are processed.
+    """
+
+    def __init__(self, size: int):
+        self.size = size
+        self.entries: "OrderedDict[str, Any]" = OrderedDict()
+        self._unsaved: Dict[str, Tuple[Any, int]] = {}  # key -> (result, created), shared with the flusher
+        self._lock = threading.Lock()
+
+    def read_stored(self) -> List[Tuple[str, str]]:
+        """The newest stored entries, newest first (blocking: run it in an executor)."""
+        with _conn_lock:
+            return get_conn().execute(
+                "SELECT key, result FROM processed ORDER BY rowid DESC LIMIT ?", (self.size,)
+            ).fetchall()
+
+    def merge_stored(self, rows: List[Tuple[str, str]]) -> None:
+        """Add rows from read_stored() as the least recently used entries; newer entries win."""
+        for key, result in rows:
+            if key not in self.entries:
+                self.entries[key] = json.loads(result)
+                self.entries.move_to_end(key, last=False)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def get(self, key: str) -> Any:
+        result = self.entries.get(key)
+        if result is not None:
+            self.entries.move_to_end(key)
+        return result
+
+    def put_many(self, items: Dict[str, Any]) -> None:
+        if not items:
+            return
+        for key, result in items.items():
+            self.entries[key] = result
+            self.entries.move_to_end(key)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+        now = int(time.time())
+        with self._lock:
+            for key, result in items.items():
+                self._unsaved[key] = (result, now)
+        PERSISTENCE.start()
+
+    def put(self, key: str, result: Any = True) -> None:
+        self.put_many({key: result})
+
+    def flush(self) -> None:
+        """Write the entries added since the last flush (write-behind thread)."""
+        with self._lock:
+            rows, self._unsaved = self._unsaved, {}
+        if not rows:
+            return
+        try:
+            with transaction() as conn:
+                conn.executemany(
+                    "INSERT OR REPLACE INTO processed (key, result, created) VALUES (?, ?, ?)",
+                    ((key, json.dumps(result), created) for key, (result, created) in rows.items()),
+                )
+        except Exception as e:
+            logger.warning("Failed to save %d idempotency key(s): %s", len(rows), e)
+            with self._lock:
+                for key, row in rows.items():
+                    self._unsaved.setdefault(key, row)
+
+
+DEDUP = IdempotencyCache(IDEMPOTENCY_CACHE_SIZE)
+PERSISTENCE.add_flusher(DEDUP.flush)
+
+
+def count_duplicate(kind: str, n: int = 1) -> None:
+    METRICS.inc("bot_duplicates_total", "Duplicate work skipped by the idempotency cache.", n, kind=kind)
+
+
+def once_per_update(func):
+    """Skip updates that were already handled. An update whose handler raised is not remembered."""
+    @functools.wraps(func)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        key = f"update:{update.update_id}"
+        if DEDUP.get(key):
+            count_duplicate("update")
+            logger.info("Skipping redelivered update %s", update.update_id)
+            return
+        result = await func(update, context)
+        DEDUP.put(key)
+        return result
+    return wrapper
+
+
+def cover_key(rec: "UserRecord", auto: bool = False) -> str:
+    """Identifies the cover a video is sent with: the user's thumbnail, or "auto" for a frame of the video."""
+    return "auto" if auto else (rec.thumbnail_unique_id or rec.thumbnail_file_id or "")
+
+
+def video_key(user_id: int, file_unique_id: Optional[str], cover: str) -> Optional[str]:
+    return f"video:{user_id}:{file_unique_id}:{cover}" if file_unique_id else None
+
+
+# ---------------- Pending video queue ----------------
+def pending_entry(message: Message, video) -> Dict[str, Any]:
+    entities_raw = None
+    if message.caption_entities:
+        entities_raw = entities_to_raw(message.caption_entities)
+    return {
+        "file_id": video.file_id,
+        "file_unique_id": video.file_unique_id,
+        "caption": message.caption or "",
+        "entities": entities_raw,
+    }
+
+
+def drop_duplicates(rec: "UserRecord", videos: List[Dict[str, Any]], cover: str) -> Tuple[List[Dict[str, Any]], int]:
+    """Remove videos queued twice or already sent with `cover`. Returns (videos to send, removed count)."""
+    todo = []
+    seen = set()
+    for video in videos:
+        key = video_key(rec.user_id, video.get("file_unique_id"), cover)
+        if key and (key in seen or DEDUP.get(key)):
+            continue
+        seen.add(key)
+        todo.append(video)
+    removed = len(videos) - len(todo)
+    if removed:
+        count_duplicate("video", removed)
+    return todo, removed
+
+
+async def send_pending_videos(bot, chat_id: int, rec: "UserRecord", cover: Union[bytes, str, None]) -> Tuple[int, List[str]]:
+    """
+    Send every queued video of `rec` with `cover` (None: an auto cover per video),
+    PENDING_SEND_CONCURRENCY at a time (the rate limiter paces the chat). Videos that fail
+    are queued again; videos already sent with this cover are skipped and counted as sent.
+    Returns (sent count, error messages).
+    """
+    key = cover_key(rec, auto=cover is None)
+    videos, duplicates = drop_duplicates(rec, rec.take_pending(), key)
+    slots = asyncio.Semaphore(PENDING_SEND_CONCURRENCY)
+    done: Dict[str, Any] = {}
+
+    async def send(video: Dict[str, Any]) -> None:
+        async with slots:
+            thumbnail = cover or await auto_cover(bot, video["file_id"], video.get("file_unique_id"))
+            if not thumbnail:
+                raise RuntimeError("no cover available")
+            message = await bot.send_video(
+                chat_id=chat_id,
+                video=video["file_id"],
+                thumbnail=thumbnail,
+                caption=video.get("caption") or "",
                 parse_mode=constants.ParseMode.HTML,
+                supports_streaming=True,
             )
+            sent_key = video_key(rec.user_id, video.get("file_unique_id"), key)
+            if sent_key:
+                done[sent_key] = {"message_id": message.message_id}
+
+    results = await asyncio.gather(*(send(v) for v in videos), return_exceptions=True)
+    DEDUP.put_many(done)
+    errors = []
+    for video, result in zip(videos, results):
+        if isinstance(result, Exception):
+            logger.warning("Failed to send pending video %s: %s", video["file_id"], result)
+            errors.append(str(result))
+            rec.add_pending(video)
+    sent = len(videos) - len(errors)
+    DB.incr("total_videos", sent)
+    return sent + duplicates, errors
+
+
+def pending_summary(sent: int, errors: List[str]) -> str:
+    if not errors:
+        return "✅ Video sent with the cover!" if sent == 1 else f"✅ {sent} videos sent with the cover!"
+    if not sent:
+        return f"❌ Error sending video: {errors[0]}"
+    return f"⚠️ {sent} videos sent, {len(errors)} failed and are kept for a retry: {errors[0]}"
+
+
+# ---------------- Force-sub membership cache ----------------
+# user_id -> (is_member, expires_at). Kept fresh by chat_member updates from the
+# force-sub channel (the bot must be an admin there to receive them).
+_member_cache: "OrderedDict[int, Tuple[bool, float]]" = OrderedDict()
+
+
+def cache_membership(user_id: int, is_member: bool) -> None:
+    ttl = MEMBER_CACHE_TTL if is_member else NON_MEMBER_CACHE_TTL
+    _member_cache[user_id] = (is_member, time.monotonic() + ttl)
+    _member_cache.move_to_end(user_id)
+    while len(_member_cache) > MEMBER_CACHE_SIZE:
+        _member_cache.popitem(last=False)
+
+
+async def is_channel_member(bot, user_id: int, recheck_negative: bool = False) -> bool:
+    """
+    Return whether user_id is in FORCE_SUB_CHANNEL_ID, asking Telegram only on a
+    cache miss or expiry. With recheck_negative a cached "not a member" is re-checked.
+    """
+    entry = _member_cache.get(user_id)
+    if entry and entry[1] > time.monotonic() and (entry[0] or not recheck_negative):
+        _member_cache.move_to_end(user_id)
+        return entry[0]
+    try:
+        member = await bot.get_chat_member(chat_id=FORCE_SUB_CHANNEL_ID, user_id=user_id)
+    except Exception:
+        # errors are not cached, the next video asks again
+        return False
+    is_member = member.status not in ("left", "kicked")
+    cache_membership(user_id, is_member)
+    return is_member
+
+
+async def chat_member_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    cmu = update.chat_member
+    if not cmu or cmu.chat.id != FORCE_SUB_CHANNEL_ID:
+        return
+    new = cmu.new_chat_member
+    cache_membership(new.user.id, new.status not in ("left", "kicked"))
+
+
+# ---------------- Static assets ----------------
+class AssetRegistry:
+    """
+    Static images (BOT_LOGO) are sent by URL only once: the file_id Telegram
+    returns is stored in the assets table and reused for every later send, so
+    Telegram does not fetch the URL again. A stored id that Telegram rejects is
+    dropped and the URL is sent (and remembered) again.
+    """
+
+    def __init__(self, sources: Dict[str, str]):
+        self.sources = sources
+        self.file_ids: Dict[str, str] = {}
+        self._loaded = False
+
+    def _load(self) -> None:
+        self._loaded = True
+        try:
+            with _conn_lock:
+                rows = get_conn().execute("SELECT name, source, file_id FROM assets").fetchall()
+        except Exception as e:
+            logger.warning("Failed to load assets: %s", e)
+            return
+        for name, source, file_id in rows:
+            if self.sources.get(name) == source:  # ids of a replaced URL are stale
+                self.file_ids[name] = file_id
+
+    async def _store(self, name: str, file_id: Optional[str]) -> None:
+        if file_id:
+            self.file_ids[name] = file_id
         else:
-            await context.bot.send_message(
-                chat_id=LOG_CHANNEL_ID,
-                text=f"<b>{html.escape(title)}</b>\n\n{body}",
-                parse_mode=constants.ParseMode.HTML,
-            )
-    except Exception as e:
-        logger.warning("Failed to send log: %s", e)
+            self.file_ids.pop(name, None)
+        await asyncio.get_running_loop().run_in_executor(None, self._save, name, file_id)
+
+    def _save(self, name: str, file_id: Optional[str]) -> None:
+        try:
+            with transaction() as conn:
+                if file_id:
+                    conn.execute(
+                        "INSERT INTO assets (name, source, file_id) VALUES (?, ?, ?) "
+                        "ON CONFLICT(name) DO UPDATE SET source = excluded.source, file_id = excluded.file_id",
+                        (name, self.sources[name], file_id),
+                    )
+                else:
+                    conn.execute("DELETE FROM assets WHERE name = ?", (name,))
+        except Exception as e:
+            logger.warning("Failed to save asset %s: %s", name, e)
+
+    async def send(self, name: str, send: Callable[[str], Any]):
+        """
+        `send(media)` makes the actual call (reply_photo, send_photo, edit_message_media ...)
+        with either the cached file_id or the asset's URL. Returns its result.
+        """
+        if not self._loaded:
+            await asyncio.get_running_loop().run_in_executor(None, self._load)
+        file_id = self.file_ids.get(name)
+        if file_id:
+            try:
+                return await send(file_id)
+            except BadRequest as e:
+                if "file" not in e.message.lower():  # e.g. "Wrong file identifier/http url specified"
+                    raise
+                logger.info("Asset %s: cached file_id rejected (%s), sending the URL again", name, e)
+                await self._store(name, None)
+        result = await send(self.sources[name])
+        if isinstance(result, Message) and result.photo:
+            await self._store(name, result.photo[-1].file_id)
+        return result
+
+
+ASSETS = AssetRegistry({"logo": BOT_LOGO})
 
 
 # ---------------- Command Handlers ----------------
@@ -214,7 +1901,9 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         f"• <code>/delthumb</code> — delete thumbnail\n\n"
         f"Tap Help for usage instructions."
     )
-    await update.message.reply_photo(photo=BOT_LOGO, caption=text, parse_mode=constants.ParseMode.HTML, reply_markup=start_keyboard())
+    await ASSETS.send("logo", lambda photo: update.message.reply_photo(
+        photo=photo, caption=text, parse_mode=constants.ParseMode.HTML, reply_markup=start_keyboard()
+    ))
 
 
 async def help_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -269,8 +1958,8 @@ async def addthumb_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("🚫 You are banned from using this bot.")
         return
     rec = ensure_user_record(user.id)
-    rec["state"] = "waiting_for_thumb"
-    save_data(DB)
+    rec.state = "waiting_for_thumb"
+    save_data(DB, user.id)
     await update.message.reply_text("📸 Send a photo to set as your thumbnail (photo only).")
 
 
@@ -280,7 +1969,7 @@ async def mythumb_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("🚫 You are banned from using this bot.")
         return
     rec = ensure_user_record(user.id)
-    thumb = rec.get("thumbnail_file_id")
+    thumb = rec.thumbnail_file_id
     if thumb:
         await update.message.reply_photo(photo=thumb, caption="🖼️ Here is your currently saved thumbnail.", reply_markup=view_thumb_keyboard())
     else:
@@ -293,15 +1982,16 @@ async def delthumb_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("🚫 You are banned from using this bot.")
         return
     rec = ensure_user_record(user.id)
-    if rec.get("thumbnail_file_id"):
-        rec["thumbnail_file_id"] = None
-        save_data(DB)
+    if rec.thumbnail_file_id:
+        rec.thumbnail_file_id = None
+        save_data(DB, user.id)
         await update.message.reply_text("🗑️ Thumbnail deleted successfully.")
     else:
         await update.message.reply_text("❌ No thumbnail to delete.")
 
 
 # ---------------- Media Handlers ----------------
+@once_per_update
 async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
     message = update.message
     user = update.effective_user
@@ -313,60 +2003,50 @@ async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
     rec = ensure_user_record(user.id)
     biggest = max(photos, key=lambda p: p.file_size or 0)
     file_id = biggest.file_id
+    # every branch below keeps this photo as the thumbnail, so process it once here
+    cover = await process_thumbnail(context.bot, file_id, biggest.file_unique_id)
+    unique_id = biggest.file_unique_id if cover else None
 
-    state = rec.get("state", "idle")
+    state = rec.state
     # If user was waiting for a thumbnail (add or edit)
     if state in ("waiting_for_thumb", "waiting_for_edit_thumb"):
-        rec["thumbnail_file_id"] = file_id
-        rec["state"] = "idle"
-        save_data(DB)
+        rec.thumbnail_file_id = file_id
+        rec.thumbnail_unique_id = unique_id
+        rec.state = "idle"
+        save_data(DB, user.id)
         await message.reply_photo(photo=file_id, caption="✅ Thumbnail saved successfully!", reply_markup=saved_thumbnail_keyboard())
         return
 
-    # If user had pending video (sent video first) and is in pending state
-    pending = rec.get("pending_video")
-    if pending:
-        # use this photo as cover and send the pending video
-        try:
-            entities_raw = pending.get("entities")
-            # convert raw entities back to MessageEntity list if present
-            entities = raw_to_entities(entities_raw)
-            await context.bot.send_video(
-                chat_id=message.chat.id,
-                video=pending["file_id"],
-                thumb=file_id,
-                caption=pending.get("caption") or "",
-                parse_mode=constants.ParseMode.HTML,
-                supports_streaming=True,
-            )
-            DB["meta"]["total_videos"] = DB["meta"].get("total_videos", 0) + 1
-            rec["pending_video"] = None
-            rec["state"] = "idle"
-            # also save this thumbnail as the user's default
-            rec["thumbnail_file_id"] = file_id
-            save_data(DB)
-            await message.reply_text("✅ Video sent with the cover!")
-
+    # If user had pending videos (sent videos first), use this photo as their cover
+    if rec.pending_videos:
+        # also save this thumbnail as the user's default
+        rec.thumbnail_file_id = file_id
+        rec.thumbnail_unique_id = unique_id
+        sent, errors = await send_pending_videos(context.bot, message.chat.id, rec, cover or file_id)
+        if not rec.pending_videos:
+            rec.state = "idle"
+        save_data(DB, user.id)
+        await message.reply_text(pending_summary(sent, errors))
+
+        if sent:
             # log nicer
             title = "Applied cover (user-provided photo for pending video)"
             body = (
                 f"User: <a href='tg://user?id={user.id}'>{html.escape(user.full_name)}</a>\n"
                 f"User ID: <code>{user.id}</code>\n"
-                f"Action: Video sent with provided cover\n"
+                f"Action: {sent} video(s) sent with provided cover\n"
             )
             await send_log(context, title, body, photo_file_id=file_id)
-            return
-        except Exception as e:
-            logger.exception("Error sending pending video with photo: %s", e)
-            await message.reply_text(f"❌ Error: {e}")
-            return
+        return
 
     # Otherwise store as new thumbnail (when user just sends a photo)
-    rec["thumbnail_file_id"] = file_id
-    save_data(DB)
+    rec.thumbnail_file_id = file_id
+    rec.thumbnail_unique_id = unique_id
+    save_data(DB, user.id)
     await message.reply_photo(photo=file_id, caption="✅ Thumbnail saved successfully!", reply_markup=saved_thumbnail_keyboard())
 
 
+@once_per_update
 async def handle_video(update: Update, context: ContextTypes.DEFAULT_TYPE):
     message = update.message
     user = update.effective_user
@@ -379,73 +2059,234 @@ async def handle_video(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await message.reply_text("❌ Please send a valid video.")
         return
 
-    # store pending video so we can verify force-sub first
-    entities_raw = None
-    if message.caption_entities:
-        entities_raw = entities_to_raw(message.caption_entities)
-    rec["pending_video"] = {"file_id": video.file_id, "caption": message.caption or "", "entities": entities_raw}
+    # albums arrive as one update per video; they are queued and handled as one batch
+    if message.media_group_id:
+        queued = rec.add_pending(pending_entry(message, video))
+        save_data(DB, user.id)
+        buffer_album_item(context.application, message, queued)
+        return
+
+    # already sent with the current cover: point to that message instead of checking and sending again
+    done = DEDUP.get(video_key(user.id, video.file_unique_id, cover_key(rec, auto=not rec.thumbnail_file_id)) or "")
+    if done:
+        count_duplicate("video")
+        await context.bot.send_message(
+            chat_id=message.chat.id,
+            text="✅ This video was already sent with your current cover.",
+            reply_to_message_id=done["message_id"],
+            allow_sending_without_reply=True,
+        )
+        return
+
+    # queue the video so we can verify force-sub first; with a full queue it is
+    # only refused if the queue cannot be sent right now
+    entry = pending_entry(message, video)
+    queued = rec.add_pending(entry)
+    note = "" if queued else f"\n❗ This video was not queued, at most {PENDING_VIDEOS_MAX} can wait."
 
     # check membership in force-sub channel
-    is_member = False
-    try:
-        member = await context.bot.get_chat_member(chat_id=FORCE_SUB_CHANNEL_ID, user_id=user.id)
-        is_member = member.status not in ("left", "kicked")
-    except Exception:
-        is_member = False
+    is_member = await is_channel_member(context.bot, user.id)
 
     if not is_member:
-        rec["state"] = "pending_force_check"
-        save_data(DB)
-        await message.reply_photo(
-            photo=BOT_LOGO,
+        rec.state = "pending_force_check"
+        save_data(DB, user.id)
+        await ASSETS.send("logo", lambda photo: message.reply_photo(
+            photo=photo,
             caption=(
                 "🚫 <b>You must join our channel to use this bot.</b>\n\n"
-                "Please join and then click ✅ Done."
+                "Please join and then click ✅ Done." + note
             ),
             parse_mode=constants.ParseMode.HTML,
             reply_markup=force_sub_keyboard(),
-        )
+        ))
         return
 
-    # user is member — apply saved thumbnail if present
-    thumb = rec.get("thumbnail_file_id")
-    if not thumb:
-        rec["state"] = "waiting_for_thumb_for_video"
-        save_data(DB)
-        await message.reply_text("❗ Please send a photo first to set as thumbnail.")
+    # user is member — apply saved thumbnail if present, else try an auto cover
+    thumb = rec.thumbnail_file_id
+    if thumb:
+        cover = await get_cover(context.bot, rec)
+    else:
+        cover = await auto_cover(context.bot, video.file_id, video.file_unique_id)
+    if not cover:
+        rec.state = "waiting_for_thumb_for_video"
+        save_data(DB, user.id)
+        await message.reply_text("❗ Please send a photo first to set as thumbnail." + note)
         return
 
-    # send video with the saved thumbnail and preserve caption entities
-    try:
-        # send with preserved caption and entities by using parse_mode and raw_entities if needed.
-        await context.bot.send_video(
-            chat_id=message.chat.id,
-            video=video.file_id,
-            thumb=thumb,
-            caption=message.caption or "",
-            parse_mode=constants.ParseMode.HTML,
-            supports_streaming=True,
-        )
-        DB["meta"]["total_videos"] = DB["meta"].get("total_videos", 0) + 1
-        rec["pending_video"] = None
-        rec["state"] = "idle"
-        save_data(DB)
-        await message.reply_text("✅ Video sent with the cover!")
-
+    # send the queued video(s) with the saved thumbnail (auto covers are made per video)
+    sent, errors = await send_pending_videos(context.bot, message.chat.id, rec, cover if thumb else None)
+    if not queued and not errors and rec.add_pending(entry):
+        # the full queue went out, now there is room for this video
+        more, more_errors = await send_pending_videos(context.bot, message.chat.id, rec, cover if thumb else None)
+        sent, errors, note = sent + more, errors + more_errors, ""
+    if not rec.pending_videos:
+        rec.state = "idle"
+    save_data(DB, user.id)
+    await message.reply_text(pending_summary(sent, errors) + note)
+
+    if sent:
         # log
-        title = "Applied cover (instant)"
+        title = "Applied cover (instant)" if thumb else "Applied cover (auto-generated)"
         body = (
             f"User: <a href='tg://user?id={user.id}'>{html.escape(user.full_name)}</a>\n"
             f"User ID: <code>{user.id}</code>\n"
-            f"Action: Video sent with saved thumbnail\n"
+            f"Action: {sent} video(s) sent with {'saved thumbnail' if thumb else 'cover from a video frame'}\n"
         )
-        await send_log(context, title, body, photo_file_id=thumb)
-    except Exception as e:
-        logger.exception("Failed to send video with saved thumb: %s", e)
-        await message.reply_text(f"❌ Error sending video: {e}")
+        await send_log(context, title, body, photo_file_id=thumb or cover)
+
+
+# ---------------- Media groups (albums) ----------------
+# Every video of an album is a separate update. handle_video queues each one
+# (like any pending video, so it is persisted) and registers it here; once
+# MEDIA_GROUP_WINDOW seconds pass without a new item the album is handled once:
+# one membership check, one save, one send_media_group, one reply and one log
+# entry. post_stop sends albums whose window is still open.
+class _Album:
+    __slots__ = ("user", "chat_id", "dropped", "timer")
+
+    def __init__(self, message: Message):
+        self.user = message.from_user
+        self.chat_id = message.chat_id
+        self.dropped = 0  # videos that did not fit in the queue
+        self.timer: Optional[asyncio.TimerHandle] = None
+
+
+_albums: Dict[Tuple[int, str], _Album] = {}
+
+
+def buffer_album_item(application: Application, message: Message, queued: bool) -> None:
+    key = (message.from_user.id, message.media_group_id)
+    album = _albums.get(key)
+    if album is None:
+        album = _albums[key] = _Album(message)
+    if not queued:
+        album.dropped += 1
+    if album.timer:
+        album.timer.cancel()
+    album.timer = asyncio.get_running_loop().call_later(
+        MEDIA_GROUP_WINDOW, lambda: application.create_task(process_album(application, key))
+    )
+
+
+async def flush_albums(application: Application) -> None:
+    """Send the albums still waiting for their window to close (on shutdown)."""
+    for key, album in list(_albums.items()):
+        if album.timer:
+            album.timer.cancel()
+        try:
+            await process_album(application, key)
+        except Exception as e:
+            logger.warning("Failed to send album %s on shutdown: %s", key, e)
+
+
+async def send_pending_album(bot, chat_id: int, rec: "UserRecord", cover: Union[bytes, str, None]) -> Tuple[int, List[str]]:
+    """
+    Send every queued video of `rec` as media groups of up to 10 videos with
+    `cover` (None: an auto cover per video). Failed groups are queued again;
+    videos already sent with this cover are skipped and counted as sent.
+    Returns (sent count, error messages).
+    """
+    key = cover_key(rec, auto=cover is None)
+    videos, duplicates = drop_duplicates(rec, rec.take_pending(), key)
+    done: Dict[str, Any] = {}
+    sent = 0
+    errors = []
+    for i in range(0, len(videos), 10):
+        chunk = videos[i:i + 10]
+        try:
+            media = [
+                InputMediaVideo(
+                    media=v["file_id"],
+                    thumbnail=cover or await auto_cover(bot, v["file_id"], v.get("file_unique_id")),
+                    caption=v.get("caption") or "",
+                    parse_mode=constants.ParseMode.HTML,
+                    supports_streaming=True,
+                )
+                for v in chunk
+            ]
+            if len(media) == 1:
+                # a media group needs at least two items
+                m = media[0]
+                messages = [await bot.send_video(chat_id=chat_id, video=m.media, thumbnail=m.thumbnail, caption=m.caption,
+                                                 parse_mode=constants.ParseMode.HTML, supports_streaming=True)]
+            else:
+                messages = await bot.send_media_group(chat_id=chat_id, media=media)
+            sent += len(chunk)
+            for v, message in zip(chunk, messages):
+                sent_key = video_key(rec.user_id, v.get("file_unique_id"), key)
+                if sent_key:
+                    done[sent_key] = {"message_id": message.message_id}
+        except Exception as e:
+            logger.warning("Failed to send album of %d videos: %s", len(chunk), e)
+            errors.append(str(e))
+            for v in chunk:
+                rec.add_pending(v)
+    DEDUP.put_many(done)
+    DB.incr("total_videos", sent)
+    return sent + duplicates, errors
+
+
+async def process_album(application: Application, key: Tuple[int, str]) -> None:
+    album = _albums.pop(key, None)
+    if not album:
+        return
+    bot = application.bot
+    user = album.user
+    chat_id = album.chat_id
+    processor = application.update_processor
+    serialized = processor.serialized(user.id) if isinstance(processor, PerUserUpdateProcessor) else contextlib.nullcontext()
+    async with serialized:
+        rec = ensure_user_record(user.id)
+        dropped = album.dropped
+        if not rec.pending_videos and not dropped:
+            return  # already sent with a photo or video the user sent in the meantime
+        note = f"\n❗ {dropped} video(s) skipped, at most {PENDING_VIDEOS_MAX} can wait." if dropped else ""
+
+        if not await is_channel_member(bot, user.id):
+            rec.state = "pending_force_check"
+            save_data(DB, user.id)
+            await ASSETS.send("logo", lambda photo: bot.send_photo(
+                chat_id=chat_id,
+                photo=photo,
+                caption=(
+                    "🚫 <b>You must join our channel to use this bot.</b>\n\n"
+                    "Please join and then click ✅ Done." + note
+                ),
+                parse_mode=constants.ParseMode.HTML,
+                reply_markup=force_sub_keyboard(),
+            ))
+            return
+
+        thumb = rec.thumbnail_file_id
+        if thumb:
+            cover = await get_cover(bot, rec)
+        else:
+            v = rec.pending_videos[0]
+            cover = await auto_cover(bot, v["file_id"], v.get("file_unique_id"))
+        if not cover:
+            rec.state = "waiting_for_thumb_for_video"
+            save_data(DB, user.id)
+            await bot.send_message(chat_id=chat_id, text="❗ Please send a photo first to set as thumbnail." + note)
+            return
+
+        sent, errors = await send_pending_album(bot, chat_id, rec, cover if thumb else None)
+        if not rec.pending_videos:
+            rec.state = "idle"
+        save_data(DB, user.id)
+        await bot.send_message(chat_id=chat_id, text=pending_summary(sent, errors) + note)
+
+        if sent:
+            title = "Applied cover (album)"
+            body = (
+                f"User: <a href='tg://user?id={user.id}'>{html.escape(user.full_name)}</a>\n"
+                f"User ID: <code>{user.id}</code>\n"
+                f"Action: album of {sent} video(s) sent with {'saved thumbnail' if thumb else 'covers from video frames'}\n"
+            )
+            LOGS.put(title, body, thumb or cover)
 
 
 # ---------------- Callback Query Router ----------------
+@once_per_update
 async def callback_query_router(update: Update, context: ContextTypes.DEFAULT_TYPE):
     q = update.callback_query
     if not q:
@@ -474,7 +2315,7 @@ async def callback_query_router(update: Update, context: ContextTypes.DEFAULT_TY
         return
 
     if data == "view_thumb":
-        thumb = rec.get("thumbnail_file_id")
+        thumb = rec.thumbnail_file_id
         if not thumb:
             try:
                 await q.edit_message_caption(caption="❌ No thumbnail found. Send a photo to set it.", reply_markup=None)
@@ -488,8 +2329,8 @@ async def callback_query_router(update: Update, context: ContextTypes.DEFAULT_TY
         return
 
     if data == "edit_thumb":
-        rec["state"] = "waiting_for_edit_thumb"
-        save_data(DB)
+        rec.state = "waiting_for_edit_thumb"
+        save_data(DB, user.id)
         try:
             await q.edit_message_caption(caption="🖼️ Please send the new thumbnail image (photo only).", reply_markup=back_button_kb("home"))
         except Exception:
@@ -497,67 +2338,64 @@ async def callback_query_router(update: Update, context: ContextTypes.DEFAULT_TY
         return
 
     if data == "del_thumb":
-        rec["thumbnail_file_id"] = None
-        save_data(DB)
+        rec.thumbnail_file_id = None
+        save_data(DB, user.id)
         try:
-            await q.edit_message_media(media=InputMediaPhoto(media=BOT_LOGO, caption="✅ Thumbnail removed successfully!"), reply_markup=back_button_kb("home"))
+            await ASSETS.send("logo", lambda photo: q.edit_message_media(
+                media=InputMediaPhoto(media=photo, caption="✅ Thumbnail removed successfully!"), reply_markup=back_button_kb("home")
+            ))
         except Exception:
             await q.edit_message_text(text="✅ Thumbnail removed successfully!", reply_markup=back_button_kb("home"))
         return
 
     if data == "force_check":
-        # verify membership then send pending video if exists
-        try:
-            member = await context.bot.get_chat_member(chat_id=FORCE_SUB_CHANNEL_ID, user_id=user.id)
-            is_member = member.status not in ("left", "kicked")
-        except Exception:
-            is_member = False
+        # verify membership then send pending video if exists (a cached "not a member"
+        # is ignored here, the user presses Done right after joining)
+        is_member = await is_channel_member(context.bot, user.id, recheck_negative=True)
 
         if not is_member:
             await q.edit_message_caption(caption="🚫 You are not a member yet. Please join the channel and click ✅ Done.", reply_markup=force_sub_keyboard())
             return
 
-        pending = rec.get("pending_video")
+        pending = rec.pending_videos
         if not pending:
             await q.edit_message_caption(caption="✅ Verified — but no pending video found.", reply_markup=back_button_kb("home"))
-            rec["state"] = "idle"
-            save_data(DB)
+            rec.state = "idle"
+            save_data(DB, user.id)
             return
 
-        thumb = rec.get("thumbnail_file_id")
-        if not thumb:
-            rec["state"] = "waiting_for_thumb_for_video"
-            save_data(DB)
+        thumb = rec.thumbnail_file_id
+        if thumb:
+            cover = await get_cover(context.bot, rec)
+        else:
+            cover = await auto_cover(context.bot, pending[0]["file_id"], pending[0].get("file_unique_id"))
+        if not cover:
+            rec.state = "waiting_for_thumb_for_video"
+            save_data(DB, user.id)
             await q.edit_message_caption(caption="❗ Please send a photo first to set as thumbnail.", reply_markup=back_button_kb("home"))
             return
 
-        # send video
+        # send every queued video in one pass
+        sent, errors = await send_pending_videos(context.bot, q.message.chat.id, rec, cover if thumb else None)
+        if not rec.pending_videos:
+            rec.state = "idle"
+        save_data(DB, user.id)
+        if errors:
+            logger.warning("Failed to send %d pending video(s) after force-check: %s", len(errors), errors[0])
         try:
-            await context.bot.send_video(
-                chat_id=q.message.chat.id,
-                video=pending["file_id"],
-                thumb=thumb,
-                caption=pending.get("caption") or "",
-                parse_mode=constants.ParseMode.HTML,
-                supports_streaming=True,
-            )
-            DB["meta"]["total_videos"] = DB["meta"].get("total_videos", 0) + 1
-            rec["pending_video"] = None
-            rec["state"] = "idle"
-            save_data(DB)
-            await q.edit_message_caption(caption="✅ Verified and video sent with your thumbnail!", reply_markup=back_button_kb("home"))
+            await q.edit_message_caption(caption=f"✅ Verified!\n{pending_summary(sent, errors)}", reply_markup=back_button_kb("home"))
+        except Exception as e:
+            logger.debug("Failed to edit force-check prompt: %s", e)
 
+        if sent:
             # log
             title = "Applied cover (after force-check)"
             body = (
                 f"User: <a href='tg://user?id={user.id}'>{html.escape(user.full_name)}</a>\n"
                 f"User ID: <code>{user.id}</code>\n"
-                f"Action: Video sent after verification\n"
+                f"Action: {sent} video(s) sent after verification{'' if thumb else ' (auto-generated cover)'}\n"
             )
-            await send_log(context, title, body, photo_file_id=thumb)
-        except Exception as e:
-            logger.exception("Failed to send pending video after force-check: %s", e)
-            await q.edit_message_caption(caption=f"❌ Error sending video: {e}", reply_markup=back_button_kb("home"))
+            await send_log(context, title, body, photo_file_id=thumb or cover)
         return
 
     if data.startswith("back_"):
@@ -575,8 +2413,173 @@ async def callback_query_router(update: Update, context: ContextTypes.DEFAULT_TY
         return
 
 
+# ---------------- Broadcast segments ----------------
+# "all", "thumb" (has a thumbnail) and "active<N>d" (sent an update in the last
+# N days), combined with "+", e.g. "active7d+thumb". Users marked dead by an
+# earlier broadcast are always left out. Every filter is served by an index:
+# delivery_dead, activity (day, id) and users_with_thumbnail.
+def parse_segment(spec: str) -> Optional[Dict[str, Any]]:
+    segment: Dict[str, Any] = {}
+    for part in spec.lower().split("+"):
+        if part == "all":
+            continue
+        if part == "thumb":
+            segment["thumb"] = True
+        elif part.startswith("active") and part.endswith("d") and part[6:-1].isdigit():
+            segment["active_days"] = min(int(part[6:-1]), ACTIVITY_DAYS)
+        else:
+            return None
+    return segment
+
+
+def _segment_sql(segment: Dict[str, Any]) -> Tuple[str, list]:
+    sql = "FROM users WHERE id NOT IN (SELECT id FROM delivery WHERE status != 'ok')"
+    params: list = []
+    if segment.get("thumb"):
+        sql += " AND json_extract(record, '$.thumbnail_file_id') IS NOT NULL"
+    if segment.get("active_days"):
+        sql += " AND id IN (SELECT id FROM activity WHERE day > ?)"
+        params.append(int(time.time() // 86400) - segment["active_days"])
+    return sql, params
+
+
+def segment_users(segment: Dict[str, Any], after: int = 0) -> List[int]:
+    """Ids of the users in `segment` above `after` (a broadcast's cursor), ascending."""
+    PERSISTENCE.flush()
+    sql, params = _segment_sql(segment)
+    with _conn_lock:
+        return [uid for (uid,) in get_conn().execute(f"SELECT id {sql} AND id > ? ORDER BY id", (*params, after))]
+
+
+def segment_size(segment: Dict[str, Any]) -> int:
+    PERSISTENCE.flush()
+    sql, params = _segment_sql(segment)
+    with _conn_lock:
+        return get_conn().execute(f"SELECT COUNT(*) {sql}", params).fetchone()[0]
+
+
+# ---------------- Broadcast engine ----------------
+# A broadcast is a row in the broadcasts table. Users are processed in id order,
+# BROADCAST_CHUNK at a time by up to BROADCAST_WORKERS concurrent senders; after
+# every chunk the last handled user id is checkpointed, so a restarted bot resumes
+# where it stopped (re-sending at most one chunk).
+class BroadcastEngine:
+    def __init__(self):
+        self.bucket = TokenBucket(BROADCAST_RATE)
+        self.tasks: Dict[int, asyncio.Task] = {}
+
+    def create_job(self, kind: str, payload: Dict[str, Any], status_chat_id: int, status_message_id: int) -> int:
+        with transaction() as conn:
+            cur = conn.execute(
+                "INSERT INTO broadcasts (kind, payload, status_chat_id, status_message_id) VALUES (?, ?, ?, ?)",
+                (kind, _dump(payload), status_chat_id, status_message_id),
+            )
+            return cur.lastrowid
+
+    def start(self, bot, job_id: int) -> None:
+        task = asyncio.create_task(self._run(bot, job_id), name=f"broadcast-{job_id}")
+        self.tasks[job_id] = task
+        task.add_done_callback(lambda _: self.tasks.pop(job_id, None))
+
+    def resume(self, bot) -> None:
+        with _conn_lock:
+            rows = get_conn().execute("SELECT id FROM broadcasts WHERE done = 0").fetchall()
+        for (job_id,) in rows:
+            logger.info("Resuming broadcast %d", job_id)
+            self.start(bot, job_id)
+
+    async def stop(self) -> None:
+        for task in list(self.tasks.values()):
+            task.cancel()
+        await asyncio.gather(*self.tasks.values(), return_exceptions=True)
+
+    def _load_job(self, job_id: int, columns: Tuple[str, ...]) -> tuple:
+        with _conn_lock:
+            return get_conn().execute(f"SELECT {', '.join(columns)} FROM broadcasts WHERE id = ?", (job_id,)).fetchone()
+
+    def _checkpoint(self, job_id: int, cursor: int, sent: int, failed: int, done: bool = False) -> None:
+        with transaction() as conn:
+            conn.execute(
+                "UPDATE broadcasts SET cursor = ?, sent = ?, failed = ?, done = ? WHERE id = ?",
+                (cursor, sent, failed, int(done), job_id),
+            )
+
+    async def _deliver(self, bot, kind: str, payload: Dict[str, Any], chat_id: int) -> str:
+        """Returns "ok", a dead status (see record_deliveries) or "failed"."""
+        for attempt in range(BROADCAST_MAX_RETRIES):
+            await self.bucket.acquire()
+            try:
+                if kind == "copy":
+                    await bot.copy_message(chat_id=chat_id, from_chat_id=payload["from_chat_id"], message_id=payload["message_id"],
+                                           rate_limit_args=PRIORITY_BROADCAST)
+                else:
+                    await bot.send_message(chat_id=chat_id, text=payload["text"], parse_mode=constants.ParseMode.HTML,
+                                           rate_limit_args=PRIORITY_BROADCAST)
+                return "ok"
+            except RetryAfter as e:
+                # flood limit hit: hold every worker, then retry this user
+                self.bucket.pause(e.retry_after + 1)
+            except Forbidden as e:
+                # blocked the bot or deleted account: skipped by later broadcasts
+                return "deactivated" if "deactivated" in e.message.lower() else "blocked"
+            except BadRequest as e:
+                return "not_found" if "chat not found" in e.message.lower() else "failed"
+            except (TimedOut, NetworkError):
+                await asyncio.sleep(2 ** attempt)
+            except Exception as e:
+                logger.warning("Broadcast to %s failed: %s", chat_id, e)
+                return "failed"
+        return "failed"
+
+    async def _report(self, bot, job: Dict[str, Any], text: str) -> None:
+        if not job["status_chat_id"]:
+            return
+        try:
+            await bot.edit_message_text(chat_id=job["status_chat_id"], message_id=job["status_message_id"], text=text)
+        except Exception as e:
+            logger.debug("Failed to edit broadcast status: %s", e)
+
+    async def _run(self, bot, job_id: int) -> None:
+        columns = ("kind", "payload", "status_chat_id", "status_message_id", "cursor", "sent", "failed")
+        loop = asyncio.get_running_loop()
+        row = await loop.run_in_executor(None, self._load_job, job_id, columns)
+        job = dict(zip(columns, row))
+        kind, payload = job["kind"], json.loads(job["payload"])
+        cursor, sent, failed = job["cursor"], job["sent"], job["failed"]
+        # the store has every shard's users; flush first so it has the newest ones too
+        targets = await loop.run_in_executor(None, segment_users, payload.get("segment") or {}, cursor)
+        total = sent + failed + len(targets)
+        workers = asyncio.Semaphore(BROADCAST_WORKERS)
+
+        async def deliver(uid: int) -> str:
+            async with workers:
+                return await self._deliver(bot, kind, payload, uid)
+
+        last_report = time.monotonic()
+        for i in range(0, len(targets), BROADCAST_CHUNK):
+            chunk = targets[i:i + BROADCAST_CHUNK]
+            results = await asyncio.gather(*(deliver(uid) for uid in chunk))
+            record_deliveries({uid: status for uid, status in zip(chunk, results) if status != "failed"})
+            ok = results.count("ok")
+            sent += ok
+            failed += len(results) - ok
+            cursor = chunk[-1]
+            await loop.run_in_executor(None, self._checkpoint, job_id, cursor, sent, failed)
+            if time.monotonic() - last_report >= BROADCAST_PROGRESS_INTERVAL:
+                last_report = time.monotonic()
+                await self._report(bot, job, f"Broadcast in progress: {sent + failed}/{total}\nSent: {sent} | Failed: {failed}")
+
+        await loop.run_in_executor(None, self._checkpoint, job_id, cursor, sent, failed, True)
+        logger.info("Broadcast %d finished. Sent: %d | Failed: %d", job_id, sent, failed)
+        await self._report(bot, job, f"Broadcast finished. Sent: {sent} | Failed: {failed}")
+
+
+BROADCASTS = BroadcastEngine()
+
+
 # ---------------- Owner-only Admin Commands ----------------
 def owner_only(func):
+    @functools.wraps(func)
     async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
         user = update.effective_user
         if not user:
@@ -593,16 +2596,52 @@ async def ping_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("Pong! ✅")
 
 
+def store_totals() -> Dict[str, int]:
+    """stats_cmd numbers from SQLite, over all shards (records flushed so far)."""
+    PERSISTENCE.flush()
+    with _conn_lock:
+        conn = get_conn()
+        users, with_thumbnail, pending = conn.execute(
+            "SELECT COUNT(*),"
+            " COUNT(json_extract(record, '$.thumbnail_file_id')),"
+            " SUM(json_array_length(record, '$.pending_videos') > 0)"
+            " FROM users"
+        ).fetchone()
+        banned = conn.execute("SELECT COUNT(*) FROM banned").fetchone()[0]
+        dead = conn.execute("SELECT COUNT(*) FROM delivery WHERE status != 'ok'").fetchone()[0]
+    return {
+        "users": users,
+        "banned": banned,
+        "dead": dead,
+        "with_thumbnail": with_thumbnail,
+        "pending": pending or 0,
+        "total_videos": meta_total("total_videos"),
+    }
+
+
 @owner_only
 async def stats_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    total_users = len(DB.get("users", {}))
-    total_banned = len(DB.get("banned", []))
-    total_videos = DB.get("meta", {}).get("total_videos", 0)
+    if SHARD_INDEX is None and DB.complete:
+        totals = {
+            "users": len(DB),
+            "banned": len(DB.banned),
+            "dead": len(DB.dead),
+            "with_thumbnail": DB.with_thumbnail,
+            "pending": len(DB.pending),
+            "total_videos": DB.meta.get("total_videos", 0),
+        }
+    else:
+        # this worker only holds its own shard (or is still loading): count the shared store
+        totals = await asyncio.get_running_loop().run_in_executor(None, store_totals)
     text = (
         f"<b>Bot Stats</b>\n\n"
-        f"Total users: <code>{total_users}</code>\n"
-        f"Banned users: <code>{total_banned}</code>\n"
-        f"Total videos processed: <code>{total_videos}</code>\n"
+        f"Total users: <code>{totals['users']}</code>\n"
+        f"Banned users: <code>{totals['banned']}</code>\n"
+        f"Unreachable users (skipped by broadcasts): <code>{totals['dead']}</code>\n"
+        f"Users with thumbnail: <code>{totals['with_thumbnail']}</code>\n"
+        f"Users with pending videos: <code>{totals['pending']}</code>\n"
+        f"Total videos processed: <code>{totals['total_videos']}</code>\n"
+        f"Thumbnail cache: <code>{THUMBS.hits}</code> hits / <code>{THUMBS.misses}</code> misses\n"
     )
     await update.message.reply_text(text, parse_mode=constants.ParseMode.HTML)
 
@@ -616,7 +2655,7 @@ async def ban_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     try:
         uid = int(args[0])
-        ban_user(uid)
+        await asyncio.get_running_loop().run_in_executor(None, ban_user, uid)
         await update.message.reply_text(f"User <code>{uid}</code> banned.", parse_mode=constants.ParseMode.HTML)
     except Exception as e:
         await update.message.reply_text(f"Error: {e}")
@@ -630,7 +2669,7 @@ async def unban_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     try:
         uid = int(args[0])
-        unban_user(uid)
+        await asyncio.get_running_loop().run_in_executor(None, unban_user, uid)
         await update.message.reply_text(f"User <code>{uid}</code> unbanned.", parse_mode=constants.ParseMode.HTML)
     except Exception as e:
         await update.message.reply_text(f"Error: {e}")
@@ -640,24 +2679,24 @@ async def unban_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def broadcast_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
     /broadcast <message text>
-    Sends a message to all users known in DB (async but owner-triggered).
+    Sends a message to all users known in DB. Runs as a background broadcast job;
+    progress is edited into the status message.
     """
     if not context.args:
         await update.message.reply_text("Usage: /broadcast Your message here")
         return
-    text = " ".join(context.args)
-    users = list(DB.get("users", {}).keys())
-    sent = 0
-    failed = 0
-    await update.message.reply_text(f"Starting broadcast to {len(users)} users...")
-    for uid in users:
-        try:
-            await context.bot.send_message(chat_id=int(uid), text=text, parse_mode=constants.ParseMode.HTML)
-            sent += 1
-            await asyncio.sleep(0.05)  # small delay to avoid flood
-        except Exception:
-            failed += 1
-    await update.message.reply_text(f"Broadcast finished. Sent: {sent} | Failed: {failed}")
+    await start_broadcast(update, context, "text", {"text": " ".join(context.args)}, {})
+
+
+async def start_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE, kind: str, payload: Dict[str, Any],
+                          segment: Dict[str, Any]) -> None:
+    size = await asyncio.get_running_loop().run_in_executor(None, segment_size, segment)
+    action = "Forwarding the replied message" if kind == "copy" else "Starting broadcast"
+    status = await update.message.reply_text(f"{action} to {size} users (unreachable users skipped)...")
+    job_id = await asyncio.get_running_loop().run_in_executor(
+        None, BROADCASTS.create_job, kind, {**payload, "segment": segment}, status.chat_id, status.message_id
+    )
+    BROADCASTS.start(context.bot, job_id)
 
 
 @owner_only
@@ -670,22 +2709,31 @@ async def dbroadcast_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # If owner replied to a message, forward that message to all users
     if update.message.reply_to_message:
         msg = update.message.reply_to_message
-        users = list(DB.get("users", {}).keys())
-        sent = 0
-        failed = 0
-        await update.message.reply_text(f"Forwarding the replied message to {len(users)} users...")
-        for uid in users:
-            try:
-                await msg.copy(chat_id=int(uid))
-                sent += 1
-                await asyncio.sleep(0.05)
-            except Exception:
-                failed += 1
-        await update.message.reply_text(f"dbroadcast finished. Sent: {sent} | Failed: {failed}")
+        await start_broadcast(update, context, "copy", {"from_chat_id": msg.chat_id, "message_id": msg.message_id}, {})
     else:
         await update.message.reply_text("Reply to a message and then use /dbroadcast to forward it to all users.")
 
 
+@owner_only
+async def sbroadcast_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    /sbroadcast <segment> [message text] - broadcast to a segment only, e.g.
+    /sbroadcast active7d+thumb Hello. Without text, the replied message is copied.
+    """
+    usage = "Usage: /sbroadcast <all|thumb|active<N>d, joined with +> <message>  (or reply to a message)"
+    segment = parse_segment(context.args[0]) if context.args else None
+    if segment is None:
+        await update.message.reply_text(usage)
+        return
+    if len(context.args) > 1:
+        await start_broadcast(update, context, "text", {"text": " ".join(context.args[1:])}, segment)
+    elif update.message.reply_to_message:
+        msg = update.message.reply_to_message
+        await start_broadcast(update, context, "copy", {"from_chat_id": msg.chat_id, "message_id": msg.message_id}, segment)
+    else:
+        await update.message.reply_text(usage)
+
+
 # ---------------- Fallback / Misc ----------------
 async def misc_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
@@ -701,38 +2749,654 @@ async def misc_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("Use /help to see public commands. To set thumbnail: /addthumb or just send a photo.")
 
 
+# ---------------- Update processing ----------------
+class FloodGuard:
+    """
+    Per-user inbound token bucket. reserve() books the user's next slot and
+    returns how long the update has to wait for it, or None when that would be
+    more than INBOUND_MAX_DELAY (the update is dropped and not booked).
+    """
+
+    def __init__(self, rate: float = INBOUND_RATE, burst: float = INBOUND_BURST, max_delay: float = INBOUND_MAX_DELAY):
+        self.rate = rate
+        self.burst = burst
+        self.max_delay = max_delay
+        # user_id -> [tokens, updated]; tokens go negative for booked slots
+        self.users: Dict[int, List[float]] = {}
+        self.pruned = time.monotonic()
+
+    def reserve(self, uid: int) -> Optional[float]:
+        now = time.monotonic()
+        if now - self.pruned > 60:
+            self.prune(now)
+        state = self.users.get(uid)
+        if state is None:
+            state = self.users[uid] = [self.burst, now]
+        tokens = min(self.burst, state[0] + (now - state[1]) * self.rate)
+        wait = max(0.0, (1 - tokens) / self.rate)
+        if wait > self.max_delay:
+            return None
+        state[0], state[1] = tokens - 1, now
+        return wait
+
+    def prune(self, now: float) -> None:
+        """Forget users whose bucket has refilled completely."""
+        self.pruned = now
+        full = [uid for uid, (tokens, updated) in self.users.items() if tokens + (now - updated) * self.rate >= self.burst]
+        for uid in full:
+            del self.users[uid]
+
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """
+    Processes up to max_concurrent_updates updates in parallel, but updates of the
+    same user one after another, in arrival order: they all work on the same
+    record in DB (e.g. photo then video, or video then the force_check callback).
+    Users who flood the bot are slowed down and then dropped by FloodGuard.
+
+    PTB's process_update holds its semaphore for the whole of do_process_update,
+    so updates waiting for FloodGuard or for their user's lock would use up the
+    slots of other users. The base semaphore is therefore unbounded and the limit
+    is `slots`, taken only while a handler runs.
+    """
+
+    def __init__(self, max_concurrent_updates: int):
+        if max_concurrent_updates < 1:
+            raise ValueError("`max_concurrent_updates` must be a positive integer!")
+        super().__init__(sys.maxsize)
+        self.slots = asyncio.BoundedSemaphore(max_concurrent_updates)
+        self._locks: Dict[int, asyncio.Lock] = {}
+        self._waiting: Dict[int, int] = {}
+        self.flood = FloodGuard()
+
+    @contextlib.asynccontextmanager
+    async def serialized(self, uid: int):
+        """Hold the user's lock; also used for work outside an update (e.g. albums)."""
+        lock = self._locks.setdefault(uid, asyncio.Lock())
+        self._waiting[uid] = self._waiting.get(uid, 0) + 1
+        try:
+            async with lock:
+                yield
+        finally:
+            self._waiting[uid] -= 1
+            if not self._waiting[uid]:
+                del self._waiting[uid]
+                del self._locks[uid]
+
+    async def do_process_update(self, update: object, coroutine) -> None:
+        user = getattr(update, "effective_user", None)
+        if user is None:
+            async with self.slots:
+                await coroutine
+            return
+        if user.id != OWNER_ID:
+            delay = self.flood.reserve(user.id)
+            if delay is None:
+                coroutine.close()
+                METRICS.inc("bot_updates_throttled_total", "Updates dropped by the per-user flood guard.")
+                return
+            if delay:
+                await asyncio.sleep(delay)
+        async with self.serialized(user.id), self.slots:
+            await coroutine
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+
+# ---------------- Metrics ----------------
+# Prometheus text exposition on http://METRICS_LISTEN:METRICS_PORT/metrics
+# (METRICS_PORT = 0 disables the endpoint; needs aiohttp).
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _labels(labels: Dict[str, Any]) -> Tuple[Tuple[str, str], ...]:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _format_labels(labels: Iterable[Tuple[str, str]]) -> str:
+    parts = []
+    for k, v in labels:
+        v = v.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        parts.append(f'{k}="{v}"')
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class Metrics:
+    """Minimal in-process registry of counters, histograms and scrape-time gauges."""
+
+    def __init__(self):
+        self._help: Dict[str, Tuple[str, str]] = {}  # name -> (type, help)
+        self._counters: Dict[str, Dict[tuple, float]] = defaultdict(dict)
+        self._histograms: Dict[str, Dict[tuple, List[float]]] = defaultdict(dict)  # bucket counts + [sum, count]
+        self._gauges: Dict[str, Callable[[], float]] = {}
+
+    def inc(self, name: str, help_text: str, n: float = 1, **labels) -> None:
+        self._help.setdefault(name, ("counter", help_text))
+        series = self._counters[name]
+        key = _labels(labels)
+        series[key] = series.get(key, 0) + n
+
+    def observe(self, name: str, help_text: str, value: float, **labels) -> None:
+        self._help.setdefault(name, ("histogram", help_text))
+        series = self._histograms[name]
+        key = _labels(labels)
+        counts = series.get(key)
+        if counts is None:
+            counts = series[key] = [0] * (len(LATENCY_BUCKETS) + 2)
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if value <= bound:
+                counts[i] += 1
+        counts[-2] += value
+        counts[-1] += 1
+
+    def gauge(self, name: str, help_text: str, fn: Callable[[], float]) -> None:
+        self._help[name] = ("gauge", help_text)
+        self._gauges[name] = fn
+
+    def render(self) -> str:
+        out = []
+        for name, (kind, help_text) in sorted(self._help.items()):
+            out.append(f"# HELP {name} {help_text}")
+            out.append(f"# TYPE {name} {kind}")
+            if kind == "counter":
+                for key, value in self._counters[name].items():
+                    out.append(f"{name}{_format_labels(key)} {value}")
+            elif kind == "gauge":
+                try:
+                    out.append(f"{name} {float(self._gauges[name]())}")
+                except Exception as e:
+                    logger.debug("Gauge %s failed: %s", name, e)
+            else:
+                for key, counts in self._histograms[name].items():
+                    for bound, n in zip(LATENCY_BUCKETS, counts):
+                        out.append(f"{name}_bucket{_format_labels(key + (('le', str(bound)),))} {n}")
+                    out.append(f"{name}_bucket{_format_labels(key + (('le', '+Inf'),))} {counts[-1]}")
+                    out.append(f"{name}_sum{_format_labels(key)} {counts[-2]}")
+                    out.append(f"{name}_count{_format_labels(key)} {counts[-1]}")
+        return "\n".join(out) + "\n"
+
+
+METRICS = Metrics()
+_in_flight = {"handlers": 0, "api": 0}
+
+
+def instrumented(func):
+    """Wrap a handler callback with latency, error and in-flight metrics and tag its log records."""
+    name = func.__name__
+
+    @functools.wraps(func)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        _in_flight["handlers"] += 1
+        start = time.perf_counter()
+        user = getattr(update, "effective_user", None)
+        tokens = (_log_user.set(user.id if user else None), _log_handler.set(name))
+        try:
+            return await func(update, context)
+        except Exception as e:
+            METRICS.inc("bot_handler_errors_total", "Handler exceptions by type.", handler=name, exception=type(e).__name__)
+            raise
+        finally:
+            _log_user.reset(tokens[0])
+            _log_handler.reset(tokens[1])
+            _in_flight["handlers"] -= 1
+            METRICS.observe("bot_handler_seconds", "Handler latency.", time.perf_counter() - start, handler=name)
+    return wrapper
+
+
+class InstrumentedRequest(HTTPXRequest):
+    """
+    HTTPXRequest that records latency and errors of every Bot API method call.
+    Requests take a slot per connection before they reach httpx, so the time
+    spent waiting for a free connection is measured per pool
+    (bot_http_pool_wait_seconds) along with the connections in use.
+    """
+
+    def __init__(self, pool: str = "api", connection_pool_size: int = 1, keepalive_connections: Optional[int] = None,
+                 keepalive_expiry: float = 5.0, pool_timeout: Optional[float] = 1.0, http_version: str = "1.1", **kwargs):
+        # read by _build_client(), which HTTPXRequest.__init__ already calls
+        self.limits = httpx.Limits(
+            max_connections=connection_pool_size,
+            max_keepalive_connections=min(connection_pool_size, keepalive_connections or connection_pool_size),
+            keepalive_expiry=keepalive_expiry,
+        )
+        super().__init__(connection_pool_size=connection_pool_size, pool_timeout=pool_timeout, http_version=http_version, **kwargs)
+        self.pool = pool
+        self.pool_timeout = pool_timeout
+        # HTTP/2 multiplexes up to ~100 streams over each connection
+        slots = connection_pool_size if http_version == "1.1" else connection_pool_size * 100
+        self._slots = asyncio.Semaphore(slots)
+        self.in_use = 0
+        METRICS.gauge(f"bot_http_{pool}_in_use", f"Requests holding a connection of the {pool} pool.", lambda: self.in_use)
+        METRICS.gauge(f"bot_http_{pool}_slots", f"Concurrent requests the {pool} pool allows.", lambda: slots)
+
+    def _build_client(self) -> httpx.AsyncClient:
+        # HTTPXRequest has no keep-alive parameter: this is the one place the
+        # limits are applied, on top of the client arguments it prepared
+        return httpx.AsyncClient(**{**self._client_kwargs, "limits": self.limits})
+
+    async def do_request(self, url: str, method: str, request_data=None, read_timeout=BaseRequest.DEFAULT_NONE,
+                         write_timeout=BaseRequest.DEFAULT_NONE, connect_timeout=BaseRequest.DEFAULT_NONE,
+                         pool_timeout=BaseRequest.DEFAULT_NONE):
+        start = time.perf_counter()
+        # the slot wait is the pool wait: it uses the call's pool_timeout like httpx would
+        timeout = self.pool_timeout if pool_timeout is BaseRequest.DEFAULT_NONE else pool_timeout
+        try:
+            await asyncio.wait_for(self._slots.acquire(), timeout)
+        except asyncio.TimeoutError:
+            METRICS.inc("bot_http_pool_timeouts_total", "Requests that gave up waiting for a connection.", pool=self.pool)
+            raise TimedOut(
+                "Pool timeout: All connections in the connection pool are occupied. Request was *not* sent to "
+                "Telegram. Consider adjusting the connection pool size or the pool timeout."
+            ) from None
+        METRICS.observe("bot_http_pool_wait_seconds", "Time requests waited for a free connection.",
+                        time.perf_counter() - start, pool=self.pool)
+        self.in_use += 1
+        try:
+            return await super().do_request(url, method, request_data, read_timeout, write_timeout, connect_timeout, pool_timeout)
+        finally:
+            self.in_use -= 1
+            self._slots.release()
+
+    async def post(self, url: str, *args, **kwargs):
+        method = url.rsplit("/", 1)[-1]
+        _in_flight["api"] += 1
+        start = time.perf_counter()
+        try:
+            return await super().post(url, *args, **kwargs)
+        except Exception as e:
+            METRICS.inc("bot_api_errors_total", "Bot API errors by method and exception type.", method=method, exception=type(e).__name__)
+            raise
+        finally:
+            _in_flight["api"] -= 1
+            METRICS.observe("bot_api_seconds", "Bot API call latency.", time.perf_counter() - start, method=method)
+
+
+def make_request(pool: str, connection_pool_size: int) -> InstrumentedRequest:
+    return InstrumentedRequest(
+        pool,
+        connection_pool_size=connection_pool_size,
+        keepalive_connections=HTTP_KEEPALIVE_CONNECTIONS,
+        keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+        connect_timeout=HTTP_CONNECT_TIMEOUT,
+        read_timeout=HTTP_READ_TIMEOUT,
+        write_timeout=HTTP_WRITE_TIMEOUT,
+        pool_timeout=HTTP_POOL_TIMEOUT,
+        http_version=HTTP_VERSION,
+    )
+
+
+def register_gauges(application: Application) -> None:
+    METRICS.gauge("bot_handlers_in_flight", "Handler callbacks currently running.", lambda: _in_flight["handlers"])
+    METRICS.gauge("bot_api_in_flight", "Bot API calls currently running.", lambda: _in_flight["api"])
+    METRICS.gauge("bot_update_queue_depth", "Updates waiting to be processed.", application.update_queue.qsize)
+    METRICS.gauge("bot_log_queue_depth", "Log events waiting for the log channel.", LOGS.queue.qsize)
+    METRICS.gauge("bot_dirty_users", "User records waiting for the write-behind flush.", PERSISTENCE.pending)
+    METRICS.gauge("bot_broadcasts_running", "Broadcast jobs running.", lambda: len(BROADCASTS.tasks))
+    METRICS.gauge("bot_users", "Known users.", lambda: len(DB))
+
+
+async def start_metrics_server():
+    if not METRICS_PORT:
+        return None
+    try:
+        from aiohttp import web
+    except ImportError:
+        logger.warning("aiohttp is not installed, /metrics endpoint disabled")
+        return None
+
+    async def metrics(request: web.Request) -> web.Response:
+        return web.Response(text=METRICS.render(), content_type="text/plain", charset="utf-8")
+
+    app = web.Application()
+    app.router.add_get("/metrics", metrics)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, METRICS_LISTEN, METRICS_PORT).start()
+    return runner
+
+
+# ---------------- Webhook server ----------------
+# RUN_MODE = "webhook" serves updates over HTTP (aiohttp) instead of long polling:
+#   POST WEBHOOK_PATH  - Telegram (or a test client) posts Update JSON here
+#   GET  /healthz      - liveness probe for the reverse proxy / orchestrator
+# With WEBHOOK_URL empty the webhook is not registered with Telegram, which makes
+# local testing easy: curl -d @update.json http://127.0.0.1:8443/webhook
+def make_webhook_app(application: Application):
+    from aiohttp import web
+
+    async def receive_update(request: web.Request) -> web.Response:
+        if WEBHOOK_SECRET and request.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET:
+            return web.Response(status=403)
+        try:
+            data = await request.json()
+        except ValueError:
+            return web.Response(status=400, text="invalid json")
+        # answer Telegram right away, the update is processed from the queue
+        await application.update_queue.put(Update.de_json(data, application.bot))
+        return web.Response()
+
+    async def healthz(request: web.Request) -> web.Response:
+        return web.json_response({
+            "status": "ok" if application.running else "starting",
+            "queued_updates": application.update_queue.qsize(),
+            "users": len(DB),
+        })
+
+    app = web.Application()
+    app.router.add_post(WEBHOOK_PATH, receive_update)
+    app.router.add_get("/healthz", healthz)
+    return app
+
+
+async def run_webhook(application: Application, listen: str = WEBHOOK_LISTEN, port: int = WEBHOOK_PORT,
+                      register: bool = True) -> None:
+    from aiohttp import web
+
+    runner = web.AppRunner(make_webhook_app(application))
+    await runner.setup()
+    site = web.TCPSite(runner, listen, port)
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    # post_init / post_stop / post_shutdown are only called by run_polling, so call them here
+    await application.initialize()
+    await post_init(application)
+    if register and WEBHOOK_URL:
+        await application.bot.set_webhook(
+            url=WEBHOOK_URL + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET or None,
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
+            allowed_updates=ALLOWED_UPDATES,
+        )
+    await application.start()
+    await site.start()
+    try:
+        await stop.wait()
+    finally:
+        await runner.cleanup()
+        await application.stop()
+        await post_stop(application)
+        await application.shutdown()
+        await post_shutdown(application)
+
+
+# ---------------- Sharding ----------------
+# RUN_MODE = "sharded": this process only receives the webhook and forwards every
+# update to worker user_id % SHARDS, a separate process running the normal bot
+# on 127.0.0.1:SHARD_BASE_PORT + i. Workers share DB_FILE (SQLite WAL): each one
+# loads and writes only its own users, keeps its counters under "<key>@<shard>"
+# in meta and reloads the ban list every BAN_REFRESH_INTERVAL seconds. stats_cmd
+# and broadcasts read all shards from the store; broadcasts run in the owner's shard.
+def update_user_id(data: Dict[str, Any]) -> Optional[int]:
+    """The user an update belongs to, from the raw update JSON."""
+    member = data.get("chat_member")
+    if member:
+        return member["new_chat_member"]["user"]["id"]
+    for kind in ("message", "edited_message", "callback_query", "my_chat_member"):
+        obj = data.get(kind)
+        if obj:
+            return (obj.get("from") or {}).get("id")
+    return None
+
+
+def shard_of(user_id: Optional[int]) -> int:
+    return user_id % SHARDS if user_id else 0
+
+
+async def refresh_bans() -> None:
+    """
+    /ban, /unban and broadcasts (which mark users dead) run in the owner's shard;
+    the other workers pick up the ban list and the dead users here.
+    """
+    while True:
+        await asyncio.sleep(BAN_REFRESH_INTERVAL)
+        try:
+            with _conn_lock:
+                conn = get_conn()
+                banned = conn.execute("SELECT id FROM banned").fetchall()
+                dead = conn.execute("SELECT id FROM delivery WHERE status != 'ok'").fetchall()
+            DB.banned = {uid for (uid,) in banned}
+            DB.dead = {uid for (uid,) in dead}
+        except Exception as e:
+            logger.warning("Failed to reload bans: %s", e)
+
+
+def run_worker(index: int) -> None:
+    """Entry point of shard worker `index` (a spawned process)."""
+    global SHARD_INDEX, RATE_LIMIT_GLOBAL, METRICS_PORT
+    SHARD_INDEX = index
+    # one log file per process: rotation is not safe across processes
+    init_process(f"{os.path.splitext(LOG_FILE)[0]}.shard{index}.log", shard=index)
+    # Telegram's limits are per bot, not per process
+    RATE_LIMIT_GLOBAL = RATE_LIMIT_GLOBAL / SHARDS
+    LOGS.bucket = TokenBucket(LOG_RATE / SHARDS, capacity=LOG_BURST)
+    THUMBS.directory = os.path.join(THUMB_DIR, f"shard{index}")
+    THUMBS.disk_budget = THUMB_CACHE_DISK_BYTES // SHARDS
+    if METRICS_PORT:
+        METRICS_PORT = METRICS_PORT + 1 + index
+    logger.info("Shard %d/%d: %d users", index, SHARDS, len(DB))
+    asyncio.run(run_webhook(build_application(), "127.0.0.1", SHARD_BASE_PORT + index, register=False))
+
+
+def make_dispatcher_app():
+    import aiohttp
+    from aiohttp import web
+
+    async def on_startup(app: web.Application) -> None:
+        app["session"] = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=30))
+
+    async def on_cleanup(app: web.Application) -> None:
+        await app["session"].close()
+
+    async def receive_update(request: web.Request) -> web.Response:
+        if WEBHOOK_SECRET and request.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET:
+            return web.Response(status=403)
+        body = await request.read()
+        try:
+            data = json.loads(body)
+        except ValueError:
+            return web.Response(status=400, text="invalid json")
+        shard = shard_of(update_user_id(data))
+        url = f"http://127.0.0.1:{SHARD_BASE_PORT + shard}{WEBHOOK_PATH}"
+        headers = {"Content-Type": "application/json"}
+        if WEBHOOK_SECRET:
+            # workers serve the same webhook app and check the secret too
+            headers["X-Telegram-Bot-Api-Secret-Token"] = WEBHOOK_SECRET
+        try:
+            async with request.app["session"].post(url, data=body, headers=headers) as resp:
+                status = resp.status
+        except aiohttp.ClientError as e:
+            logger.warning("Shard %d unreachable: %s", shard, e)
+            status = 503
+        # a non-2xx answer makes Telegram deliver the update again later
+        return web.Response(status=status)
+
+    async def healthz(request: web.Request) -> web.Response:
+        shards = []
+        for i in range(SHARDS):
+            try:
+                async with request.app["session"].get(f"http://127.0.0.1:{SHARD_BASE_PORT + i}/healthz") as resp:
+                    shards.append(await resp.json())
+            except aiohttp.ClientError:
+                shards.append({"status": "down"})
+        ok = all(s.get("status") == "ok" for s in shards)
+        return web.json_response({"status": "ok" if ok else "degraded", "shards": shards}, status=200 if ok else 503)
+
+    app = web.Application()
+    app.on_startup.append(on_startup)
+    app.on_cleanup.append(on_cleanup)
+    app.router.add_post(WEBHOOK_PATH, receive_update)
+    app.router.add_get("/healthz", healthz)
+    return app
+
+
+async def run_dispatcher() -> None:
+    from aiohttp import web
+    from telegram import Bot
+
+    runner = web.AppRunner(make_dispatcher_app())
+    await runner.setup()
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    if WEBHOOK_URL:
+        async with Bot(BOT_TOKEN) as bot:
+            await bot.set_webhook(
+                url=WEBHOOK_URL + WEBHOOK_PATH,
+                secret_token=WEBHOOK_SECRET or None,
+                max_connections=WEBHOOK_MAX_CONNECTIONS,
+                allowed_updates=ALLOWED_UPDATES,
+            )
+    await web.TCPSite(runner, WEBHOOK_LISTEN, WEBHOOK_PORT).start()
+    try:
+        await stop.wait()
+    finally:
+        await runner.cleanup()
+
+
+def run_sharded() -> None:
+    ctx = multiprocessing.get_context("spawn")
+    workers = [ctx.Process(target=run_worker, args=(i,), name=f"shard-{i}") for i in range(SHARDS)]
+    for worker in workers:
+        worker.start()
+    try:
+        asyncio.run(run_dispatcher())
+    finally:
+        # workers flush their write-behind state on SIGTERM
+        for worker in workers:
+            worker.terminate()
+        for worker in workers:
+            worker.join()
+
+
 # ---------------- Startup ----------------
-def main():
-    if not BOT_TOKEN or BOT_TOKEN == "PUT_YOUR_BOT_TOKEN_HERE":
-        print("Please set BOT_TOKEN in the script.")
-        return
-    application = Application.builder().token(BOT_TOKEN).build()
+async def post_init(application: Application):
+    application.bot_data["metrics_runner"] = await start_metrics_server()
+    # before the first update: redelivered updates have to be recognised
+    try:
+        DEDUP.merge_stored(await asyncio.get_running_loop().run_in_executor(None, DEDUP.read_stored))
+    except Exception as e:
+        logger.warning("Failed to load the idempotency cache: %s", e)
+    LOGS.start(application.bot)
+    THUMBS.load()  # index the cover cache in the background
+    # pick up broadcasts interrupted by the last shutdown (in the owner's shard, where they are started)
+    if SHARD_INDEX is None or SHARD_INDEX == shard_of(OWNER_ID):
+        BROADCASTS.resume(application.bot)
+    if SHARD_INDEX is not None:
+        application.bot_data["ban_refresh"] = asyncio.create_task(refresh_bans())
+    if not DB.complete:
+        application.bot_data["warm_up"] = asyncio.create_task(warm_up(DB, SHARD_INDEX))
+    if application.job_queue is not None:
+        application.job_queue.run_repeating(sweep_job, interval=SWEEP_INTERVAL, first=SWEEP_INTERVAL, name="sweeper")
+    else:
+        logger.warning('JobQueue not available (pip install "python-telegram-bot[job-queue]"): stale state sweeper disabled')
+
+
+async def post_stop(application: Application):
+    # the bot can still send here; Application.shutdown() closes its connections
+    await flush_albums(application)
+    await BROADCASTS.stop()
+    await LOGS.stop(application.bot)
+
+
+async def post_shutdown(application: Application):
+    for key in ("ban_refresh", "warm_up"):
+        if application.bot_data.get(key):
+            application.bot_data[key].cancel()
+    if _thumb_pool is not None:
+        _thumb_pool.shutdown(wait=False, cancel_futures=True)
+    if application.bot_data.get("metrics_runner"):
+        await application.bot_data["metrics_runner"].cleanup()
+    # write everything the write-behind layer still holds before the process exits
+    await asyncio.get_running_loop().run_in_executor(None, PERSISTENCE.stop)
+
+
+def build_application(
+    token: Optional[str] = None,
+    request: Optional[BaseRequest] = None,
+    base_url: Optional[str] = None,
+) -> Application:
+    """
+    Create the Application with every handler registered. `token` and `request`
+    default to BOT_TOKEN and the instrumented HTTP transport; bench.py passes a
+    fake request to run the handlers offline and loadtest.py a `base_url` pointing
+    at its local Bot API stand-in (e.g. "http://127.0.0.1:8081").
+    """
+    builder = (
+        Application.builder()
+        .token(token or BOT_TOKEN)
+        .request(request or make_request("api", HTTP_POOL_SIZE))
+        .get_updates_request(make_request("updates", HTTP_UPDATES_POOL_SIZE))
+        .concurrent_updates(PerUserUpdateProcessor(MAX_CONCURRENT_UPDATES))
+        .rate_limiter(PriorityRateLimiter())
+        .post_init(post_init)
+        .post_stop(post_stop)
+        .post_shutdown(post_shutdown)
+    )
+    if base_url:
+        builder = builder.base_url(f"{base_url}/bot").base_file_url(f"{base_url}/file/bot")
+    application = builder.build()
 
     # public commands
-    application.add_handler(CommandHandler("start", start))
-    application.add_handler(CommandHandler("help", help_cmd))
-    application.add_handler(CommandHandler("addthumb", addthumb_cmd))
-    application.add_handler(CommandHandler("mythumb", mythumb_cmd))
-    application.add_handler(CommandHandler("delthumb", delthumb_cmd))
+    application.add_handler(CommandHandler("start", instrumented(start)))
+    application.add_handler(CommandHandler("help", instrumented(help_cmd)))
+    application.add_handler(CommandHandler("addthumb", instrumented(addthumb_cmd)))
+    application.add_handler(CommandHandler("mythumb", instrumented(mythumb_cmd)))
+    application.add_handler(CommandHandler("delthumb", instrumented(delthumb_cmd)))
 
     # owner commands
-    application.add_handler(CommandHandler("ping", ping_cmd))
-    application.add_handler(CommandHandler("stats", stats_cmd))
-    application.add_handler(CommandHandler("ban", ban_cmd))
-    application.add_handler(CommandHandler("unban", unban_cmd))
-    application.add_handler(CommandHandler("broadcast", broadcast_cmd))
-    application.add_handler(CommandHandler("dbroadcast", dbroadcast_cmd))
+    application.add_handler(CommandHandler("ping", instrumented(ping_cmd)))
+    application.add_handler(CommandHandler("stats", instrumented(stats_cmd)))
+    application.add_handler(CommandHandler("ban", instrumented(ban_cmd)))
+    application.add_handler(CommandHandler("unban", instrumented(unban_cmd)))
+    application.add_handler(CommandHandler("broadcast", instrumented(broadcast_cmd)))
+    application.add_handler(CommandHandler("dbroadcast", instrumented(dbroadcast_cmd)))
+    application.add_handler(CommandHandler("sbroadcast", instrumented(sbroadcast_cmd)))
 
     # media and callbacks
-    application.add_handler(MessageHandler(filters.PHOTO, handle_photo))
-    application.add_handler(MessageHandler(filters.VIDEO | filters.Document.VIDEO, handle_video))
-    application.add_handler(CallbackQueryHandler(callback_query_router))
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, misc_handler))
+    application.add_handler(MessageHandler(filters.PHOTO, instrumented(handle_photo)))
+    application.add_handler(MessageHandler(filters.VIDEO | filters.Document.VIDEO, instrumented(handle_video)))
+    application.add_handler(CallbackQueryHandler(instrumented(callback_query_router)))
+    application.add_handler(ChatMemberHandler(instrumented(chat_member_update), ChatMemberHandler.CHAT_MEMBER))
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, instrumented(misc_handler)))
+    register_gauges(application)
+    return application
 
+
+def main():
+    if len(sys.argv) == 3 and sys.argv[1] in ("export", "import"):
+        command, path = sys.argv[1:]
+        setup_logging()
+        n = export_data(path) if command == "export" else import_data(path)
+        print(f"{command}: {n} users ({path})")
+        return
+    if not BOT_TOKEN or BOT_TOKEN == "PUT_YOUR_BOT_TOKEN_HERE":
+        print("Please set BOT_TOKEN in the script.")
+        return
+    if RUN_MODE == "sharded":
+        # the dispatcher only logs; every worker loads its own shard
+        setup_logging()
+        migrate_json_to_sqlite()  # once, before the workers open the store
+        logger.info("Starting bot (webhook on %s:%s%s, %d shards)...", WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_PATH, SHARDS)
+        run_sharded()
+        return
+    init_process()
+    application = build_application()
+
+    if RUN_MODE == "webhook":
+        logger.info("Starting bot (webhook on %s:%s%s)...", WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_PATH)
+        asyncio.run(run_webhook(application))
+        return
     logger.info("Starting bot...")
-    application.run_polling(allowed_updates=[
-        "message", "callback_query", "edited_message", "channel_post", "my_chat_member", "chat_member"
-    ])
+    application.run_polling(allowed_updates=ALLOWED_UPDATES)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,337 @@
+#!/usr/bin/env python3
+# loadtest.py - end-to-end load harness for bot.py against a local fake Bot API
+#
+# Starts an aiohttp stand-in for the Telegram Bot API (getUpdates, sendVideo,
+# sendPhoto, sendMessage, getChatMember, copyMessage, editMessage*, getFile, ...)
+# with configurable latency, flood limits (429 + retry_after) and error
+# injection, then runs the bot exactly as main() wires it (build_application +
+# polling) against it. Simulated users replay a photo/video/callback mix in a
+# closed loop while the owner fires broadcasts; the harness reports throughput,
+# tail latency per scenario and how many calls were answered with 429/5xx.
+#
+# Usage:
+#   python loadtest.py --users 200 --duration 30
+#   python loadtest.py --mix video=8,photo=1,callback=1 --latency 40 --error-rate 0.02 --broadcast-every 10
+
+import argparse
+import asyncio
+import io
+import os
+import random
+import sys
+import tempfile
+import time
+from collections import Counter, defaultdict
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from aiohttp import web
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+TOKEN = "123456:LOADTEST"
+OWNER = 1
+BROADCAST_MARKER = "loadtest broadcast"
+FLOOD_LIMITED = ("send", "copy", "edit", "forward")
+
+
+class Bucket:
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def take(self) -> float:
+        """Take a token; returns 0 on success, otherwise seconds until one is available."""
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+
+# ---------------- Fake Bot API server ----------------
+class FakeBotAPI:
+    def __init__(self, args):
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.updates: List[Dict[str, Any]] = []
+        self.next_update_id = 1
+        self.new_update = asyncio.Event()
+        self.calls: Counter = Counter()
+        self.rejected: Counter = Counter()  # (method, code) answered with an error
+        self.global_bucket = Bucket(args.global_limit, args.global_limit)
+        self.chat_buckets: Dict[int, Bucket] = {}
+        self.expected: Dict[int, Tuple[Set[str], asyncio.Future]] = {}
+        self.broadcast_delivered = 0
+        self._message_id = 0
+        self._photo = self._make_photo()
+
+    @staticmethod
+    def _make_photo() -> bytes:
+        try:
+            from PIL import Image
+        except ImportError:
+            return b""
+        buf = io.BytesIO()
+        Image.new("RGB", (1280, 720), (200, 60, 60)).save(buf, "JPEG")
+        return buf.getvalue()
+
+    # --- load generator side ---
+    def push_update(self, update: Dict[str, Any]) -> None:
+        update["update_id"] = self.next_update_id
+        self.next_update_id += 1
+        self.updates.append(update)
+        self.new_update.set()
+
+    def expect(self, chat_id: int, methods: Set[str]) -> asyncio.Future:
+        fut = asyncio.get_running_loop().create_future()
+        self.expected[chat_id] = (methods, fut)
+        return fut
+
+    # --- HTTP side ---
+    def _error(self, method: str, code: int, description: str, retry_after: Optional[int] = None) -> web.Response:
+        self.rejected[(method, code)] += 1
+        body = {"ok": False, "error_code": code, "description": description}
+        if retry_after is not None:
+            body["parameters"] = {"retry_after": retry_after}
+        return web.json_response(body, status=code)
+
+    def _message(self, chat_id: int, **extra) -> Dict[str, Any]:
+        self._message_id += 1
+        msg = {"message_id": self._message_id, "date": int(time.time()), "chat": {"id": chat_id, "type": "private"}}
+        msg.update(extra)
+        return msg
+
+    async def _get_updates(self, params: Dict[str, str]) -> List[Dict[str, Any]]:
+        offset = int(params.get("offset") or 0)
+        self.updates = [u for u in self.updates if u["update_id"] >= offset]
+        if not self.updates:
+            self.new_update.clear()
+            try:
+                await asyncio.wait_for(self.new_update.wait(), float(params.get("timeout") or 0))
+            except asyncio.TimeoutError:
+                pass
+        limit = int(params.get("limit") or 100)
+        return self.updates[:limit]
+
+    def _result(self, method: str, params: Dict[str, str]) -> Any:
+        chat_id = int(params.get("chat_id") or 0)
+        if method == "getMe":
+            return {"id": 999, "is_bot": True, "first_name": "LoadTest", "username": "loadtest_bot"}
+        if method == "getChatMember":
+            user_id = int(params["user_id"])
+            return {"status": "member", "user": {"id": user_id, "is_bot": False, "first_name": f"u{user_id}"}}
+        if method == "getFile":
+            return {"file_id": params["file_id"], "file_unique_id": params["file_id"], "file_size": len(self._photo),
+                    "file_path": f"photos/{params['file_id']}.jpg"}
+        if method in ("sendPhoto", "editMessageMedia"):
+            return self._message(chat_id, photo=[{"file_id": f"sent{self._message_id}", "file_unique_id": f"s{self._message_id}",
+                                                  "width": 320, "height": 320}])
+        if method.startswith(FLOOD_LIMITED):
+            return self._message(chat_id)
+        return True
+
+    def _resolve(self, method: str, params: Dict[str, str]) -> None:
+        chat_id = int(params.get("chat_id") or 0)
+        if method == "sendMessage" and params.get("text", "").startswith(BROADCAST_MARKER):
+            self.broadcast_delivered += 1
+            return
+        if method == "answerCallbackQuery":
+            return
+        waiting = self.expected.get(chat_id)
+        if waiting and method in waiting[0] and not waiting[1].done():
+            del self.expected[chat_id]
+            waiting[1].set_result(time.monotonic())
+
+    async def handle_method(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        params = {k: v for k, v in (await request.post()).items() if isinstance(v, str)}
+        self.calls[method] += 1
+        if method == "getUpdates":
+            return web.json_response({"ok": True, "result": await self._get_updates(params)})
+
+        if self.args.latency:
+            jitter = self.rng.uniform(-self.args.jitter, self.args.jitter)
+            await asyncio.sleep(max(0.0, self.args.latency + jitter) / 1000)
+        if self.args.error_rate and self.rng.random() < self.args.error_rate:
+            return self._error(method, 500, "Internal Server Error: injected")
+        if method.startswith(FLOOD_LIMITED):
+            chat_id = int(params.get("chat_id") or 0)
+            bucket = self.chat_buckets.setdefault(chat_id, Bucket(self.args.chat_limit, self.args.chat_burst))
+            wait = max(self.global_bucket.take(), bucket.take())
+            if wait:
+                return self._error(method, 429, "Too Many Requests: retry after", retry_after=max(1, round(wait)))
+        result = self._result(method, params)
+        self._resolve(method, params)
+        return web.json_response({"ok": True, "result": result})
+
+    async def handle_file(self, request: web.Request) -> web.Response:
+        self.calls["<file download>"] += 1
+        return web.Response(body=self._photo, content_type="image/jpeg")
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self.handle_method)
+        app.router.add_get("/file/bot{token}/{path:.*}", self.handle_file)
+        return app
+
+
+# ---------------- Load generator ----------------
+def _from(uid: int) -> Dict[str, Any]:
+    return {"id": uid, "is_bot": False, "first_name": f"u{uid}"}
+
+
+def _message(uid: int, **content) -> Dict[str, Any]:
+    msg = {"message_id": random.randint(1, 1 << 30), "date": int(time.time()), "chat": {"id": uid, "type": "private"}, "from": _from(uid)}
+    msg.update(content)
+    return {"message": msg}
+
+
+def make_update(kind: str, uid: int, n: int) -> Tuple[Dict[str, Any], Set[str]]:
+    """A synthetic update plus the Bot API methods that mark it as answered."""
+    if kind == "photo":
+        sizes = [{"file_id": f"p{uid}_{n}_{s}", "file_unique_id": f"pu{uid}_{n}_{s}", "width": s, "height": s, "file_size": s * 100}
+                 for s in (90, 1280)]
+        return _message(uid, photo=sizes), {"sendPhoto", "sendMessage"}
+    if kind == "video":
+        video = {"file_id": f"v{uid}_{n}", "file_unique_id": f"vu{uid}_{n}", "width": 1280, "height": 720, "duration": 30}
+        return _message(uid, video=video, caption=f"video {n}"), {"sendMessage", "sendPhoto"}
+    prompt = {"message_id": 1, "date": 0, "chat": {"id": uid, "type": "private"},
+              "photo": [{"file_id": "logo", "file_unique_id": "logo", "width": 320, "height": 320}]}
+    query = {"id": f"{uid}_{n}", "from": _from(uid), "chat_instance": "lt", "data": "force_check", "message": prompt}
+    return {"callback_query": query}, {"editMessageCaption", "sendMessage"}
+
+
+async def simulated_user(api: FakeBotAPI, uid: int, args, latencies: Dict[str, List[float]], timeouts: Counter,
+                         stop_at: float) -> None:
+    rng = random.Random(args.seed + uid)
+    kinds, weights = zip(*args.mix.items())
+    n = 0
+    # everybody starts by setting a thumbnail, like a real first session
+    kind = "photo"
+    while time.monotonic() < stop_at:
+        n += 1
+        update, answered_by = make_update(kind, uid, n)
+        fut = api.expect(uid, answered_by)
+        start = time.monotonic()
+        api.push_update(update)
+        try:
+            done = await asyncio.wait_for(fut, args.timeout)
+            latencies[kind].append(done - start)
+        except asyncio.TimeoutError:
+            timeouts[kind] += 1
+            api.expected.pop(uid, None)
+        await asyncio.sleep(rng.expovariate(1 / args.think) if args.think else 0)
+        kind = rng.choices(kinds, weights)[0]
+
+
+async def owner_broadcasts(api: FakeBotAPI, args, stop_at: float) -> int:
+    sent = 0
+    while args.broadcast_every and time.monotonic() + args.broadcast_every < stop_at:
+        await asyncio.sleep(args.broadcast_every)
+        sent += 1
+        text = f"/broadcast {BROADCAST_MARKER} {sent}"
+        api.push_update(_message(OWNER, text=text, entities=[{"type": "bot_command", "offset": 0, "length": 10}]))
+    return sent
+
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))] * 1000
+
+
+def report(api: FakeBotAPI, latencies, timeouts: Counter, elapsed: float, broadcasts: int) -> None:
+    total = sum(len(v) for v in latencies.values())
+    print(f"\nthroughput: {total / elapsed:.1f} answered updates/sec over {elapsed:.1f}s")
+    print(f"{'scenario':<10} {'answered':>9} {'timeouts':>9} {'p50 ms':>9} {'p90 ms':>9} {'p99 ms':>9} {'max ms':>9}")
+    for kind in sorted(set(latencies) | set(timeouts)):
+        lat = latencies[kind]
+        print(f"{kind:<10} {len(lat):>9} {timeouts[kind]:>9} {percentile(lat, .5):>9.1f} {percentile(lat, .9):>9.1f} "
+              f"{percentile(lat, .99):>9.1f} {max(lat, default=0) * 1000:>9.1f}")
+    print(f"\nbroadcasts started: {broadcasts}, broadcast messages delivered: {api.broadcast_delivered}")
+    retries = sum(api.rejected.values())
+    print(f"calls answered with an error (each one retried or failed by the bot): {retries}")
+    for (method, code), n in sorted(api.rejected.items()):
+        print(f"  {method:<22} {code}: {n}")
+    print("Bot API calls:")
+    for method, n in api.calls.most_common():
+        print(f"  {method:<22} {n}")
+
+
+async def run(args) -> None:
+    workdir = tempfile.mkdtemp(prefix="coverbot-load-")
+    os.chdir(workdir)
+    sys.path.insert(0, HERE)
+    import bot
+
+    bot.init_process()
+    bot.OWNER_ID = OWNER
+    bot.METRICS_PORT = 0
+    bot.MAX_CONCURRENT_UPDATES = args.concurrency
+    print(f"workdir: {workdir}")
+
+    api = FakeBotAPI(args)
+    runner = web.AppRunner(api.app())
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", args.port).start()
+
+    # same wiring as main(), pointed at the local server
+    application = bot.build_application(token=TOKEN, base_url=f"http://127.0.0.1:{args.port}")
+    await application.initialize()
+    await bot.post_init(application)
+    await application.updater.start_polling(poll_interval=0, timeout=5, allowed_updates=bot.ALLOWED_UPDATES)
+    await application.start()
+
+    latencies: Dict[str, List[float]] = defaultdict(list)
+    timeouts: Counter = Counter()
+    start = time.monotonic()
+    stop_at = start + args.duration
+    users = [simulated_user(api, OWNER + 1 + i, args, latencies, timeouts, stop_at) for i in range(args.users)]
+    results = await asyncio.gather(owner_broadcasts(api, args, stop_at), *users)
+    elapsed = time.monotonic() - start
+
+    await application.updater.stop()
+    await application.stop()
+    await bot.post_stop(application)
+    await application.shutdown()
+    await bot.post_shutdown(application)
+    await runner.cleanup()
+    report(api, latencies, timeouts, elapsed, results[0])
+
+
+def parse_mix(value: str) -> Dict[str, float]:
+    mix = {}
+    for part in value.split(","):
+        kind, _, weight = part.partition("=")
+        if kind not in ("photo", "video", "callback"):
+            raise argparse.ArgumentTypeError(f"unknown scenario {kind!r}")
+        mix[kind] = float(weight or 1)
+    return mix
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="End-to-end load test for bot.py against a fake Bot API")
+    parser.add_argument("--users", type=int, default=100, help="simulated users")
+    parser.add_argument("--duration", type=float, default=20, help="seconds of load")
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix("video=6,photo=1,callback=2"))
+    parser.add_argument("--think", type=float, default=0.5, help="mean seconds a user waits between updates")
+    parser.add_argument("--broadcast-every", type=float, default=0, help="owner starts a broadcast every N seconds")
+    parser.add_argument("--latency", type=float, default=20, help="Bot API latency in ms")
+    parser.add_argument("--jitter", type=float, default=10, help="+/- ms added to the latency")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of calls answered with a 500")
+    parser.add_argument("--global-limit", type=float, default=30, help="sends per second before 429")
+    parser.add_argument("--chat-limit", type=float, default=1, help="sends per second per chat before 429")
+    parser.add_argument("--chat-burst", type=float, default=5, help="burst allowed per chat")
+    parser.add_argument("--concurrency", type=int, default=64, help="bot.MAX_CONCURRENT_UPDATES")
+    parser.add_argument("--timeout", type=float, default=30, help="seconds before an update counts as unanswered")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--seed", type=int, default=1)
+    asyncio.run(run(parser.parse_args(argv)))
+
+
+if __name__ == "__main__":
+    main()